@@ -1,20 +1,34 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, flash
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, g, Response
 import os
 from werkzeug.utils import secure_filename
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+from flask_compress import Compress
 from trendyol_service import TrendyolService
-from smartbill_service import SmartBillService
+from smartbill_service import SmartBillService, SmartBillError
 from user_manager import UserManager
-from datetime import datetime, timedelta
+from cache import get_redis_client, shared_cache
+from json_provider import OrjsonProvider
+from invoice_cleanup import start_invoice_cleanup_scheduler
+from postal_code import parse_postal_code_page
+from datetime import date, datetime, timedelta
 from functools import wraps
-import io
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import hashlib
+import logging
+import queue
 import requests
-import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# The services log request details at DEBUG; set LOG_LEVEL=DEBUG to see them
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 session_secret = 'trendyol'
 if not session_secret or session_secret == 'dev-secret-key':
@@ -24,32 +38,194 @@ if not session_secret or session_secret == 'dev-secret-key':
 
 app.secret_key = session_secret
 
+# Keep sessions server-side in Redis when it is available, so the cookie
+# only carries a session id instead of the signed session payload
+redis_client = get_redis_client()
+if redis_client is not None:
+    from flask_session import Session
+
+    app.config.update(SESSION_TYPE='redis', SESSION_REDIS=redis_client)
+    Session(app)
+
+# Compress runs after add_json_etag (after_request handlers run in reverse
+# registration order), so the ETag is computed from the uncompressed body
+Compress(app)
+
+
+@app.after_request
+def add_json_etag(response):
+    """
+    Tag JSON GET responses with a hash of their body so polling clients
+    revalidate with If-None-Match and get an empty 304 when nothing changed.
+    """
+    if (request.method == 'GET' and response.status_code == 200
+            and response.mimetype == 'application/json'
+            and not response.is_streamed):
+        response.set_etag(
+            hashlib.blake2b(response.get_data(), digest_size=16).hexdigest())
+        # Per-user data: browsers may keep it but must revalidate first
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response = response.make_conditional(request)
+    return response
+
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# One manager per process: it holds the connection pool, the user cache and
+# the derived encryption keys. Extensions reach it through app.extensions.
 user_manager = UserManager()
+app.extensions['user_manager'] = user_manager
+
+
+# Connections are reused across requests instead of reopening users.db
+# each time. Connections are created lazily (so none are shared across
+# forked workers); when all are checked out an extra one is opened and
+# closed again on release, rather than making the request wait.
+DB_POOL_SIZE = 8
+_db_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+
+
+def _checkout_db():
+    try:
+        return _db_pool.get_nowait()
+    except queue.Empty:
+        return user_manager.connect()
+
+
+def _release_db(conn):
+    # Never hand the next user a connection with a half-done transaction
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _db_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+@contextmanager
+def db_conn():
+    """
+    Borrow a pooled connection for a short block of queries. Long-running
+    handlers use this so they do not hold a connection across API calls.
+    """
+    conn = _checkout_db()
+    try:
+        yield conn
+    finally:
+        _release_db(conn)
+
+
+def get_db():
+    """
+    Return the pooled SQLite connection for the current request, checking
+    it out on first use. It goes back to the pool in close_db at teardown.
+    """
+    db = getattr(g, '_db', None)
+    if db is None:
+        db = g._db = _checkout_db()
+    return db
+
+
+@app.teardown_appcontext
+def close_db(exception):
+    db = g.pop('_db', None)
+    if db is not None:
+        _release_db(db)
+
+
+# Records an issued invoice unless the order already has one. A conflict
+# means a concurrent request recorded another SmartBill invoice for the same
+# order while this one was being issued; the first row is kept and the
+# caller reports the duplicate so it can be reversed. The text is shared so
+# the pooled connections parse it once.
+SQL_RECORD_INVOICE = '''
+    INSERT INTO order_invoices
+        (user_id, order_id, invoice_series, invoice_number)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id, order_id) DO NOTHING
+'''
+
+
+def record_invoice(conn, user_id, order_id, series, number):
+    """
+    Record an issued invoice. Returns None, or the (series, number) already
+    recorded for the order when the new invoice is a duplicate.
+    """
+    cursor = conn.execute(SQL_RECORD_INVOICE,
+                          (user_id, order_id, series, number))
+    if cursor.rowcount:
+        return None
+    existing = conn.execute(
+        'SELECT invoice_series, invoice_number FROM order_invoices WHERE user_id = ? AND order_id = ?',
+        (user_id, order_id)).fetchone()
+    print(f"[ERROR] Duplicate SmartBill invoice {series}-{number} for order "
+          f"{order_id} (user {user_id}): already recorded as "
+          f"{existing[0]}-{existing[1]}; reverse the duplicate")
+    return existing
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return user_manager.get_user_by_id(int(user_id))
+    # Served from UserManager's in-process cache after the first request.
+    # Credentials are only read from the database if the request uses them.
+    return user_manager.get_user_identity(int(user_id))
 
 
 def get_trendyol_service():
     if not current_user.is_authenticated:
         return None
-    return TrendyolService(api_key=current_user.trendyol_api_key,
-                           api_secret=current_user.trendyol_api_secret,
-                           supplier_id=current_user.trendyol_supplier_id)
+    service = getattr(g, '_trendyol_service', None)
+    if service is None:
+        service = g._trendyol_service = TrendyolService(
+            api_key=current_user.trendyol_api_key,
+            api_secret=current_user.trendyol_api_secret,
+            supplier_id=current_user.trendyol_supplier_id)
+    return service
 
 
 def get_smartbill_service():
     if not current_user.is_authenticated:
         return None
-    return SmartBillService(api_token=current_user.smartbill_api_token,
-                            email=current_user.smartbill_email,
-                            company_cif=current_user.smartbill_company_cif)
+    service = getattr(g, '_smartbill_service', None)
+    if service is None:
+        service = g._smartbill_service = SmartBillService(
+            api_token=current_user.smartbill_api_token,
+            email=current_user.smartbill_email,
+            company_cif=current_user.smartbill_company_cif)
+    return service
+
+
+# SmartBill document series per (user, company CIF, document type). The
+# nextNumber in the response changes whenever an invoice is issued, so
+# invoice-creating endpoints invalidate the entry. Without Redis each worker
+# keeps its own copy and only the worker that issued the invoice sees the
+# invalidation, so callers whose nextNumber ends up on an invoice pass
+# refresh=True to skip the cached value.
+series_cache = shared_cache('sb:series:', ttl=90)
+
+
+def _series_cache_key(document_type):
+    return (f'{current_user.id}:{current_user.smartbill_company_cif or ""}:'
+            f'{document_type}')
+
+
+def get_cached_document_series(smartbill_service, document_type='f',
+                               refresh=False):
+    key = _series_cache_key(document_type)
+    result = None if refresh else series_cache.get(key)
+    if result is None:
+        result = smartbill_service.get_document_series(
+            document_type=document_type)
+        if not (isinstance(result, dict) and 'error' in result):
+            series_cache.set(key, result)
+    return result
+
+
+def invalidate_document_series(document_type='f'):
+    series_cache.delete(_series_cache_key(document_type))
 
 
 def check_credentials():
@@ -57,9 +233,7 @@ def check_credentials():
         return False
     if current_user.is_admin():
         return False
-    return bool(current_user.trendyol_api_key
-                and current_user.trendyol_api_secret
-                and current_user.trendyol_supplier_id)
+    return current_user.has_trendyol_credentials
 
 
 def check_smartbill_credentials():
@@ -67,55 +241,50 @@ def check_smartbill_credentials():
         return False
     if current_user.is_admin():
         return False
-    return bool(current_user.smartbill_api_token
-                and current_user.smartbill_email
-                and current_user.smartbill_company_cif)
-
+    return current_user.has_smartbill_credentials
 
-def cleanup_old_invoices(max_age_days=30):
-    """
-    Delete invoice PDFs older than max_age_days from static/invoices directory.
-    Called automatically during invoice uploads to manage storage.
-    """
-    try:
-        invoices_dir = os.path.join(os.getcwd(), 'static', 'invoices')
 
-        if not os.path.exists(invoices_dir):
-            return
+def admin_required(f):
 
-        cutoff_time = time.time() - (max_age_days * 24 * 60 * 60)
-        deleted_count = 0
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user.is_authenticated or not current_user.is_admin():
+            flash('You need admin privileges to access this page.', 'danger')
+            return redirect(url_for('index'))
+        return f(*args, **kwargs)
 
-        for filename in os.listdir(invoices_dir):
-            filepath = os.path.join(invoices_dir, filename)
+    return decorated_function
 
-            if os.path.isfile(filepath) and filename.endswith('.pdf'):
-                file_modified_time = os.path.getmtime(filepath)
 
-                if file_modified_time < cutoff_time:
-                    try:
-                        os.remove(filepath)
-                        deleted_count += 1
-                        print(f"[CLEANUP] Deleted old invoice: {filename}")
-                    except Exception as e:
-                        print(f"[CLEANUP] Failed to delete {filename}: {e}")
+def require_trendyol(f):
+    """
+    Reject users without Trendyol credentials and pass the request's
+    TrendyolService to the view as the trendyol_service argument.
+    """
 
-        if deleted_count > 0:
-            print(
-                f"[CLEANUP] Deleted {deleted_count} invoice(s) older than {max_age_days} days"
-            )
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not check_credentials():
+            return jsonify({'error':
+                            'Trendyol credentials not configured.'}), 401
+        kwargs['trendyol_service'] = get_trendyol_service()
+        return f(*args, **kwargs)
 
-    except Exception as e:
-        print(f"[CLEANUP] Error during invoice cleanup: {e}")
+    return decorated_function
 
 
-def admin_required(f):
+def require_smartbill(f):
+    """
+    Reject users without SmartBill credentials and pass the request's
+    SmartBillService to the view as the smartbill_service argument.
+    """
 
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not current_user.is_authenticated or not current_user.is_admin():
-            flash('You need admin privileges to access this page.', 'danger')
-            return redirect(url_for('index'))
+        if not check_smartbill_credentials():
+            return jsonify({'error':
+                            'SmartBill credentials not configured.'}), 401
+        kwargs['smartbill_service'] = get_smartbill_service()
         return f(*args, **kwargs)
 
     return decorated_function
@@ -297,7 +466,6 @@ def admin_delete_user(user_id):
 @admin_required
 def admin_add_invoice():
     try:
-        import sqlite3
         order_id = request.form.get('order_id', '').strip()
         series = request.form.get('series', '').strip()
         number = request.form.get('number', '').strip()
@@ -305,27 +473,22 @@ def admin_add_invoice():
         if not order_id or not series or not number:
             return jsonify({'error': 'All fields are required'}), 400
 
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-
-        # Check if invoice exists for current user
-        c.execute(
-            'SELECT id FROM order_invoices WHERE user_id = ? AND order_id = ?',
-            (current_user.id, order_id))
-        existing = c.fetchone()
-
-        if existing:
-            conn.close()
-            return jsonify(
-                {'error': f'Invoice already exists for order {order_id}'}), 409
+        db = get_db()
+        c = db.cursor()
 
+        # The UNIQUE(user_id, order_id) constraint turns a duplicate into a no-op
         c.execute(
             '''
             INSERT INTO order_invoices (user_id, order_id, invoice_series, invoice_number)
             VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, order_id) DO NOTHING
         ''', (current_user.id, order_id, series, number))
-        conn.commit()
-        conn.close()
+
+        if c.rowcount == 0:
+            return jsonify(
+                {'error': f'Invoice already exists for order {order_id}'}), 409
+
+        db.commit()
 
         return jsonify({
             'success': True,
@@ -340,7 +503,6 @@ def admin_add_invoice():
 @admin_required
 def admin_edit_invoice(invoice_id):
     try:
-        import sqlite3
         order_id = request.form.get('order_id', '').strip()
         series = request.form.get('series', '').strip()
         number = request.form.get('number', '').strip()
@@ -348,35 +510,32 @@ def admin_edit_invoice(invoice_id):
         if not order_id or not series or not number:
             return jsonify({'error': 'All fields are required'}), 400
 
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-
-        # Check if invoice exists and belongs to current user
-        c.execute('SELECT id FROM order_invoices WHERE id = ? AND user_id = ?',
-                  (invoice_id, current_user.id))
-        if not c.fetchone():
-            conn.close()
-            return jsonify({'error': 'Invoice not found'}), 404
-
-        # Check for duplicate order_id for this user
-        c.execute(
-            'SELECT id FROM order_invoices WHERE user_id = ? AND order_id = ? AND id != ?',
-            (current_user.id, order_id, invoice_id))
-        existing = c.fetchone()
-        if existing:
-            conn.close()
-            return jsonify(
-                {'error': f'Invoice already exists for order {order_id}'}), 409
+        db = get_db()
+        c = db.cursor()
 
+        # Update only if the invoice belongs to the current user and no other
+        # invoice of theirs already uses the new order_id
         c.execute(
             '''
             UPDATE order_invoices 
             SET order_id = ?, invoice_series = ?, invoice_number = ?
             WHERE id = ? AND user_id = ?
-        ''', (order_id, series, number, invoice_id, current_user.id))
+              AND NOT EXISTS (
+                  SELECT 1 FROM order_invoices
+                  WHERE user_id = ? AND order_id = ? AND id != ?)
+        ''', (order_id, series, number, invoice_id, current_user.id,
+              current_user.id, order_id, invoice_id))
 
-        conn.commit()
-        conn.close()
+        if c.rowcount == 0:
+            c.execute(
+                'SELECT 1 FROM order_invoices WHERE id = ? AND user_id = ?',
+                (invoice_id, current_user.id))
+            if not c.fetchone():
+                return jsonify({'error': 'Invoice not found'}), 404
+            return jsonify(
+                {'error': f'Invoice already exists for order {order_id}'}), 409
+
+        db.commit()
 
         return jsonify({
             'success': True,
@@ -391,20 +550,17 @@ def admin_edit_invoice(invoice_id):
 @admin_required
 def admin_delete_invoice(invoice_id):
     try:
-        import sqlite3
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
+        db = get_db()
+        c = db.cursor()
 
         # Only delete invoices belonging to current user
         c.execute('DELETE FROM order_invoices WHERE id = ? AND user_id = ?',
                   (invoice_id, current_user.id))
 
         if c.rowcount == 0:
-            conn.close()
             return jsonify({'error': 'Invoice not found'}), 404
 
-        conn.commit()
-        conn.close()
+        db.commit()
 
         return jsonify({
             'success': True,
@@ -414,19 +570,44 @@ def admin_delete_invoice(invoice_id):
         return jsonify({'error': str(e)}), 500
 
 
+# Search results are paged newest first; size is capped so a single
+# request cannot dump the whole table
+ADMIN_SEARCH_PAGE_SIZE = 100
+ADMIN_SEARCH_MAX_PAGE_SIZE = 500
+
+
 @app.route('/admin/invoices/search', methods=['GET'])
 @login_required
 @admin_required
 def admin_search_invoices():
     try:
-        import sqlite3
         search_term = request.args.get('q', '').strip()
+        page = max(int(request.args.get('page', 0)), 0)
+        size = int(request.args.get('size', ADMIN_SEARCH_PAGE_SIZE))
+        size = min(max(size, 1), ADMIN_SEARCH_MAX_PAGE_SIZE)
+        # One extra row tells the client whether another page exists
+        paging = (size + 1, page * size)
 
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
+        db = get_db()
+        c = db.cursor()
 
         # Admin can see ALL invoices from ALL users
-        if search_term:
+        if len(search_term) >= 3:
+            # Trigram index lookup; the term is quoted as a single phrase
+            # so FTS query syntax in the input is matched literally
+            phrase = '"' + search_term.replace('"', '""') + '"'
+            c.execute(
+                '''
+                SELECT oi.id, oi.order_id, oi.invoice_series, oi.invoice_number, oi.created_at, u.username
+                FROM order_invoices_fts
+                JOIN order_invoices oi ON oi.id = order_invoices_fts.rowid
+                LEFT JOIN users u ON oi.user_id = u.id
+                WHERE order_invoices_fts MATCH ?
+                ORDER BY oi.created_at DESC
+                LIMIT ? OFFSET ?
+            ''', (phrase, ) + paging)
+        elif search_term:
+            # Trigrams need at least 3 characters, shorter terms use LIKE
             c.execute(
                 '''
                 SELECT oi.id, oi.order_id, oi.invoice_series, oi.invoice_number, oi.created_at, u.username
@@ -434,20 +615,23 @@ def admin_search_invoices():
                 LEFT JOIN users u ON oi.user_id = u.id
                 WHERE oi.order_id LIKE ? OR oi.invoice_series LIKE ? OR oi.invoice_number LIKE ?
                 ORDER BY oi.created_at DESC
-            ''', (f'%{search_term}%', f'%{search_term}%', f'%{search_term}%'))
+                LIMIT ? OFFSET ?
+            ''', (f'%{search_term}%', f'%{search_term}%', f'%{search_term}%')
+                      + paging)
         else:
             c.execute('''
                 SELECT oi.id, oi.order_id, oi.invoice_series, oi.invoice_number, oi.created_at, u.username
                 FROM order_invoices oi
                 LEFT JOIN users u ON oi.user_id = u.id
                 ORDER BY oi.created_at DESC
-            ''')
+                LIMIT ? OFFSET ?
+            ''', paging)
 
         rows = c.fetchall()
-        conn.close()
+        has_more = len(rows) > size
 
         invoices = []
-        for row in rows:
+        for row in rows[:size]:
             invoices.append({
                 'id': row[0],
                 'order_id': row[1],
@@ -457,19 +641,21 @@ def admin_search_invoices():
                 'username': row[5] if row[5] else 'Unknown'
             })
 
-        return jsonify({'invoices': invoices})
+        return jsonify({
+            'invoices': invoices,
+            'page': page,
+            'size': size,
+            'has_more': has_more
+        })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/orders', methods=['GET'])
 @login_required
-def get_orders():
-    if not check_credentials():
-        return jsonify({'error': 'Trendyol credentials not configured.'}), 401
-
+@require_trendyol
+def get_orders(trendyol_service):
     try:
-        trendyol_service = get_trendyol_service()
         page = int(request.args.get('page', 0))
         size = int(request.args.get('size', 50))
         status = request.args.get('status', '')
@@ -501,12 +687,9 @@ def get_orders():
 
 @app.route('/api/products', methods=['GET'])
 @login_required
-def get_products():
-    if not check_credentials():
-        return jsonify({'error': 'Trendyol credentials not configured.'}), 401
-
+@require_trendyol
+def get_products(trendyol_service):
     try:
-        trendyol_service = get_trendyol_service()
         page = int(request.args.get('page', 0))
         size = int(request.args.get('size', 50))
         barcode = request.args.get('barcode', '')
@@ -531,12 +714,9 @@ def get_products():
 
 @app.route('/api/shipment-packages', methods=['GET'])
 @login_required
-def get_shipment_packages():
-    if not check_credentials():
-        return jsonify({'error': 'Trendyol credentials not configured.'}), 401
-
+@require_trendyol
+def get_shipment_packages(trendyol_service):
     try:
-        trendyol_service = get_trendyol_service()
         page = int(request.args.get('page', 0))
         size = int(request.args.get('size', 50))
         status = request.args.get('status', '')
@@ -563,16 +743,12 @@ def get_shipment_packages():
 
 @app.route('/api/smartbill/series', methods=['GET'])
 @login_required
-def get_smartbill_series():
-    if not check_smartbill_credentials():
-        return jsonify(
-            {'error': 'SmartBill credentials not fully configured.'}), 401
-
+@require_smartbill
+def get_smartbill_series(smartbill_service):
     try:
-        smartbill_service = get_smartbill_service()
         document_type = request.args.get('type', 'f')
-        result = smartbill_service.get_document_series(
-            document_type=document_type)
+        result = get_cached_document_series(smartbill_service,
+                                            document_type=document_type)
 
         if isinstance(result, dict) and 'error' in result:
             print(f"[DEBUG] SmartBill Series Error: {result['error']}")
@@ -586,14 +762,12 @@ def get_smartbill_series():
 
 @app.route('/api/smartbill/next-invoice-number', methods=['GET'])
 @login_required
-def get_next_invoice_number():
-    if not check_smartbill_credentials():
-        return jsonify({'error': 'SmartBill credentials not configured.'}), 401
-
+@require_smartbill
+def get_next_invoice_number(smartbill_service):
     try:
-        smartbill_service = get_smartbill_service()
-        series_result = smartbill_service.get_document_series(
-            document_type='f')
+        series_result = get_cached_document_series(smartbill_service,
+                                                   document_type='f',
+                                                   refresh=True)
 
         if isinstance(series_result, dict) and 'error' in series_result:
             return jsonify({'error': series_result['error']}), 500
@@ -620,13 +794,9 @@ def get_next_invoice_number():
 
 @app.route('/api/smartbill/invoices', methods=['GET'])
 @login_required
-def list_smartbill_invoices():
-    if not check_smartbill_credentials():
-        return jsonify(
-            {'error': 'SmartBill credentials not fully configured.'}), 401
-
+@require_smartbill
+def list_smartbill_invoices(smartbill_service):
     try:
-        smartbill_service = get_smartbill_service()
         series = request.args.get('series', None)
         number = request.args.get('number', None)
         date = request.args.get('date', None)
@@ -647,13 +817,9 @@ def list_smartbill_invoices():
 
 @app.route('/api/smartbill/invoice/pdf', methods=['GET'])
 @login_required
-def get_smartbill_invoice_pdf():
-    if not check_smartbill_credentials():
-        return jsonify(
-            {'error': 'SmartBill credentials not fully configured.'}), 401
-
+@require_smartbill
+def get_smartbill_invoice_pdf(smartbill_service):
     try:
-        smartbill_service = get_smartbill_service()
         series = request.args.get('series', '')
         number = request.args.get('number', '')
 
@@ -661,37 +827,30 @@ def get_smartbill_invoice_pdf():
             return jsonify({'error':
                             'Both series and number are required'}), 400
 
-        result = smartbill_service.get_invoice_pdf(series, number)
-
-        if isinstance(result, dict) and 'error' in result:
-            error_msg = result['error']
-            print(f"[DEBUG] SmartBill PDF Error: {error_msg}")
-            if 'credentials' in error_msg.lower():
-                return jsonify(result), 401
-            elif 'forbidden' in error_msg.lower():
-                return jsonify(result), 403
-            elif 'not found' in error_msg.lower() or '404' in error_msg:
+        try:
+            pdf_chunks = smartbill_service.stream_invoice_pdf(series, number)
+        except SmartBillError as e:
+            print(f"[DEBUG] SmartBill PDF Error: {e}")
+            if e.status == 404:
                 return jsonify(
                     {'error': f'Invoice {series}-{number} not found'}), 404
-            else:
-                return jsonify(result), 500
+            return jsonify({'error': str(e)}), e.status
 
-        return send_file(io.BytesIO(result),
-                         mimetype='application/pdf',
-                         as_attachment=True,
-                         download_name=f'invoice_{series}_{number}.pdf')
+        return Response(pdf_chunks,
+                        mimetype='application/pdf',
+                        headers={
+                            'Content-Disposition':
+                            f'attachment; filename=invoice_{series}_{number}.pdf'
+                        })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/smartbill/invoice/reverse', methods=['POST'])
 @login_required
-def reverse_smartbill_invoice():
-    if not check_smartbill_credentials():
-        return jsonify({'error': 'SmartBill credentials not configured.'}), 401
-
+@require_smartbill
+def reverse_smartbill_invoice(smartbill_service):
     try:
-        smartbill_service = get_smartbill_service()
         data = request.get_json()
         series = data.get('series', '').strip()
         number = data.get('number', '').strip()
@@ -714,6 +873,7 @@ def reverse_smartbill_invoice():
             else:
                 return jsonify(result), 500
 
+        invalidate_document_series()
         print(f"[DEBUG] SmartBill Reverse Success for {series}-{number}: {result}")
         return jsonify(result)
     except Exception as e:
@@ -723,13 +883,10 @@ def reverse_smartbill_invoice():
 
 @app.route('/api/label/<package_id>', methods=['GET'])
 @login_required
-def download_label(package_id):
+@require_trendyol
+def download_label(package_id, trendyol_service):
     print(f"[DEBUG] Attempting to download label for package_id: {package_id}")
-    if not check_credentials():
-        return jsonify({'error': 'Trendyol credentials not configured.'}), 401
-
     try:
-        trendyol_service = get_trendyol_service()
         label_data, status_code = trendyol_service.get_shipping_label(
             package_id)
         print(
@@ -737,10 +894,12 @@ def download_label(package_id):
         )
 
         if label_data and status_code == 200:
-            return send_file(label_data,
-                             mimetype='application/pdf',
-                             as_attachment=True,
-                             download_name=f'label_{package_id}.pdf')
+            return Response(label_data,
+                            mimetype='application/pdf',
+                            headers={
+                                'Content-Disposition':
+                                f'attachment; filename=label_{package_id}.pdf'
+                            })
         else:
             error_messages = {
                 401: 'Unauthorized: Invalid or expired credentials',
@@ -755,37 +914,62 @@ def download_label(package_id):
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/postal-code/<postal_code>', methods=['GET'])
-@login_required
-def lookup_postal_code(postal_code):
-    try:
-        from bs4 import BeautifulSoup
+# Postal code -> city/county mappings do not change, so lookups are kept
+# for 30 days and share one HTTP session with coduripostale.net
+POSTAL_CODE_TTL = 30 * 24 * 60 * 60
+postal_cache = shared_cache('pc:', ttl=POSTAL_CODE_TTL, maxsize=10000)
+postal_session = requests.Session()
+# Lookups are idempotent GETs, so connection errors and gateway errors are
+# retried with a short backoff before giving up
+postal_session.mount(
+    'https://',
+    HTTPAdapter(pool_connections=10,
+                pool_maxsize=50,
+                max_retries=Retry(total=2,
+                                  backoff_factor=0.2,
+                                  status_forcelist=(502, 503, 504),
+                                  allowed_methods=('GET', ),
+                                  raise_on_status=False)))
+
+
+def fetch_postal_code_location(postal_code):
+    """
+    Look up city and county for a Romanian postal code on coduripostale.net.
+    Returns {'city': ..., 'county': ...} or None when the code is not found.
+    """
+    location = postal_cache.get(postal_code)
+    if location is not None:
+        return location
+
+    url = f'https://www.coduripostale.net/{postal_code}'
+    headers = {
+        'User-Agent':
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+    }
 
-        url = f'https://www.coduripostale.net/{postal_code}'
-        headers = {
-            'User-Agent':
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
+    response = postal_session.get(url, headers=headers, timeout=10)
 
-        response = requests.get(url, headers=headers, timeout=10)
+    if response.status_code == 200:
+        location = parse_postal_code_page(response.content)
+        if location:
+            postal_cache.set(postal_code, location)
+            return location
 
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.content, 'html.parser')
+    return None
 
-            table = soup.find('table')
-            if table:
-                rows = table.find_all('tr')
-                if len(rows) > 1:
-                    cols = rows[1].find_all('td')
-                    if len(cols) >= 4:
-                        city = cols[2].text.strip()
-                        county = cols[3].text.strip()
 
-                        return jsonify({
-                            'success': True,
-                            'city': city,
-                            'county': county
-                        })
+@app.route('/api/postal-code/<postal_code>', methods=['GET'])
+@login_required
+def lookup_postal_code(postal_code):
+    try:
+        location = fetch_postal_code_location(postal_code)
+
+        if location:
+            return jsonify({
+                'success': True,
+                'city': location['city'],
+                'county': location['county']
+            })
 
         return jsonify({
             'success':
@@ -804,25 +988,21 @@ def lookup_postal_code(postal_code):
 
 @app.route('/api/smartbill/create-invoice', methods=['POST'])
 @login_required
-def create_smartbill_invoice():
-    if not check_smartbill_credentials():
-        return jsonify({'error': 'SmartBill credentials not configured.'}), 401
-
+@require_smartbill
+def create_smartbill_invoice(smartbill_service):
     try:
-        import sqlite3
         invoice_data = request.get_json()
         order_id = invoice_data.get('orderNumber')
 
         if not order_id:
             return jsonify({'error': 'Order number is required'}), 400
 
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
+        db = get_db()
+        c = db.cursor()
         c.execute(
             'SELECT invoice_series, invoice_number FROM order_invoices WHERE user_id = ? AND order_id = ?',
             (current_user.id, str(order_id)))
         existing = c.fetchone()
-        conn.close()
 
         if existing:
             return jsonify({
@@ -831,7 +1011,6 @@ def create_smartbill_invoice():
                 'number': existing[1]
             }), 409
 
-        smartbill_service = get_smartbill_service()
         result = smartbill_service.create_invoice(invoice_data)
         print(f"[DEBUG] SmartBill create_invoice result: {result}")
 
@@ -842,15 +1021,22 @@ def create_smartbill_invoice():
         invoice_series = result.get('series', '')
         invoice_number = result.get('number', '')
 
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute(
-            '''
-            INSERT INTO order_invoices (user_id, order_id, invoice_series, invoice_number)
-            VALUES (?, ?, ?, ?)
-        ''', (current_user.id, str(order_id), invoice_series, invoice_number))
-        conn.commit()
-        conn.close()
+        existing = record_invoice(db, current_user.id, str(order_id),
+                                  invoice_series, invoice_number)
+        db.commit()
+        invalidate_document_series()
+
+        if existing:
+            return jsonify({
+                'error':
+                f'Invoice already exists for order {order_id}; the new '
+                f'invoice {invoice_series}-{invoice_number} is a duplicate '
+                f'and must be reversed',
+                'series': existing[0],
+                'number': existing[1],
+                'newSeries': invoice_series,
+                'newNumber': invoice_number
+            }), 409
 
         return jsonify({
             'success':
@@ -871,9 +1057,7 @@ def create_smartbill_invoice():
 @login_required
 def get_order_invoice(order_id):
     try:
-        import sqlite3
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
+        c = get_db().cursor()
         c.execute(
             '''
             SELECT invoice_series, invoice_number, created_at 
@@ -881,7 +1065,6 @@ def get_order_invoice(order_id):
             WHERE user_id = ? AND order_id = ?
         ''', (current_user.id, str(order_id)))
         row = c.fetchone()
-        conn.close()
 
         if row:
             return jsonify({
@@ -910,23 +1093,18 @@ def get_gestiune():
 @login_required
 def get_all_order_invoices():
     try:
-        import sqlite3
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
+        c = get_db().cursor()
         c.execute(
             'SELECT order_id, invoice_series, invoice_number, created_at FROM order_invoices WHERE user_id = ?',
             (current_user.id, ))
-        rows = c.fetchall()
-        conn.close()
 
-        invoices = []
-        for row in rows:
-            invoices.append({
-                'order_number': row[0],
-                'series': row[1],
-                'number': row[2],
-                'created_at': row[3]
-            })
+        # Built straight off the cursor; the list is serialized by orjson
+        invoices = [{
+            'order_number': row[0],
+            'series': row[1],
+            'number': row[2],
+            'created_at': row[3]
+        } for row in c]
 
         return jsonify({'invoices': invoices})
     except Exception as e:
@@ -956,16 +1134,13 @@ def upload_invoice_to_trendyol():
             return jsonify({'error':
                             'Trendyol credentials not configured.'}), 401
 
-        user = current_user._get_current_object()
-        pdf_content = pdf_file.read()
         filename = secure_filename(f"invoice_{order_id}_{pdf_file.filename}")
 
-        trendyol_service = TrendyolService(user.trendyol_api_key,
-                                           user.trendyol_api_secret,
-                                           user.trendyol_supplier_id)
+        trendyol_service = get_trendyol_service()
 
+        # Hand over the upload's spooled file rather than a bytes copy of it
         result = trendyol_service.upload_invoice_file(
-            order_id, pdf_content, filename=filename)
+            order_id, pdf_file.stream, filename=filename)
 
         if 'error' in result:
             return jsonify({'error':
@@ -1009,22 +1184,18 @@ def upload_smartbill_invoice_to_trendyol():
             return jsonify({'error':
                             'SmartBill credentials not configured.'}), 401
 
-        user = current_user._get_current_object()
-
         smartbill_service = get_smartbill_service()
-        pdf_content = smartbill_service.get_invoice_pdf(series, number)
-
-        if isinstance(pdf_content, dict) and 'error' in pdf_content:
+        try:
+            pdf_content = smartbill_service.get_invoice_pdf(series, number)
+        except SmartBillError as e:
             return jsonify({
                 'error':
-                f'Failed to download invoice from SmartBill: {pdf_content["error"]}'
+                f'Failed to download invoice from SmartBill: {e}'
             }), 500
 
         filename = f"invoice_{shipment_package_id}_{series}_{number}.pdf"
 
-        trendyol_service = TrendyolService(user.trendyol_api_key,
-                                           user.trendyol_api_secret,
-                                           user.trendyol_supplier_id)
+        trendyol_service = get_trendyol_service()
 
         result = trendyol_service.upload_invoice_file(
             shipment_package_id,
@@ -1047,14 +1218,100 @@ def upload_smartbill_invoice_to_trendyol():
         return jsonify({'error': str(e)}), 500
 
 
-def generate_invoice_data_from_order(order, user, use_gestiune=True):
+# Trendyol SKUs whose SmartBill product code differs from the merchant SKU
+SKU_REMAP = {
+    "TYBE5ZISTJCR2Q5O74": "6290360593661",
+    "TYBZTU26IL7M50OR26": "6290360599168",
+    "TYBOOEG4YXK6HCXL86": "6291108735411",
+    "PMPE7SEBBAN4ZPP211": "6290360599120",
+    "TYBO6S9ZD26OA6NI63": "6290360598888",
+    "TYB46RAYZ8NJKLLI50": "6290362345749",
+    "776291108737194": "6291108737194",
+    "PMPGPLCV5FBWOBKL66": "6290306595771",
+    "TYB50R0MDLQTMSGA13": "6290362345749",
+    "TYBMF5JUXY6R2ILI26": "6290362345749",
+    "TYBG2PCBBTTXM2Z558": "6298043160865",
+    "TYBUZOW2O04GCF0H47": "6290306595771",
+    "DH-6290362340362": "6290362340362",
+    "DH-6291107456485": "6291107456485",
+    "DH-6290362345749": "6290362345749",
+    "344259RYI9KM4NWZ": "6290362340362",
+    "TYBDVN19MS50NE4L05": "6291108737194",
+    "PMPNUJML9VHN1WSL78": "6290362346548",
+    "TYBY6WXHAX51S4K146": "6290362346548",
+    "DH-6295199802700": "6295199802700",
+    "DH-6294015181272": "6294015181272",
+    "DH-6291108738504": "6291108738504",
+    "DH-6290360598918": "6290360598918",
+    "899365NXPSOQXOR5": "6290360599113",
+    "DH-6290362340638": "6290362340638",
+    "TYBC9FYOAYWMH5V824": "6298043160865",
+    "2992155993566": "6290362349679",
+    "54512289WHIP1": "6290362349648",
+    "PMPX7MWI02JJOZ5O03": "6290360595764",
+    "PMPCHUVPFHKM851K80": "6290362340638",
+    "4064666318097": "1100011127",
+    "TYBVLGRVD5MIVGV049": "6290360598901",
+    "TYB1LV9CP4QBMKDL08": "6298043160964",
+    "PMPIHBSEOOZSJJB821": "6290362344506",
+    "PMP9V4UX54QSMIVM71": "6290362346531",
+    "TYBNTUAF3RG4369H97": "6291108737194",
+    "TYBN0O65AFCYAWO087": "6298043160964",
+    "TYB61GZIOG8D9CHN23": "6298043160964",
+    "TYC14OQK3N169892658027912": "6291108738290",
+}
+
+
+def prefetch_postal_codes(orders):
     """
-    Generate SmartBill invoice data from Trendyol order
+    Warm postal_cache with the distinct postal codes of the orders in one
+    concurrent burst, so building their invoices only hits the cache and
+    codes shared by several orders are fetched once.
     """
-    from datetime import date
-    import requests
-    from bs4 import BeautifulSoup
+    postal_codes = set()
+    for order in orders:
+        invoice_addr = order.get('invoiceAddress') or {}
+        shipment_addr = order.get('shipmentAddress') or {}
+        postal_code = invoice_addr.get('postalCode', '') or shipment_addr.get(
+            'postalCode', '')
+        if postal_code:
+            postal_codes.add(postal_code)
+
+    def prefetch(postal_code):
+        try:
+            fetch_postal_code_location(postal_code)
+        except Exception as e:
+            # generate_invoice_data_from_order retries and reports it
+            print(f"[DEBUG] Postal code prefetch error: {str(e)}")
+
+    if postal_codes:
+        with ThreadPoolExecutor(max_workers=BULK_WORKERS) as executor:
+            list(executor.map(prefetch, postal_codes))
+
+
+def get_invoice_series_name(smartbill_service):
+    """
+    Name of the user's first SmartBill invoice series, or a placeholder
+    when it cannot be fetched
+    """
+    series_name = 'SERIE_FACTURA'
+    try:
+        series_result = get_cached_document_series(smartbill_service, 'f')
+        if series_result and 'list' in series_result and len(
+                series_result['list']) > 0:
+            first_series = series_result['list'][0]
+            series_name = first_series.get('name', series_name)
+    except:
+        pass
+    return series_name
+
 
+def generate_invoice_data_from_order(order, user, use_gestiune=True,
+                                     series_name=None):
+    """
+    Generate SmartBill invoice data from Trendyol order. Bulk callers pass
+    series_name so it is looked up once per run rather than per order.
+    """
     if use_gestiune:
         warehouse_name = user.smartbill_gestiune or ''
         foloseste_stock = True
@@ -1064,116 +1321,27 @@ def generate_invoice_data_from_order(order, user, use_gestiune=True):
 
     # Format products
     products = []
+    # Same for every line of the order
+    product_description = f"Numar comanda Trendyol:{order.get('orderNumber', '')}"
+    product_currency = order.get('currencyCode', 'RON')
 
     for line in order.get('lines', []):
-        # codul = line.get('sku', '')
-        codul = line.get('merchantSku', '')
-        if line.get('merchantSku', '') == "merchantSku":
-            codul = line.get('sku', '')
-        if line.get('sku', '') == "TYBE5ZISTJCR2Q5O74":
-            codul = "6290360593661"
-        elif line.get('sku', '') == "TYBZTU26IL7M50OR26":
-            codul = "6290360599168"
-        elif line.get('sku', '') == "TYBOOEG4YXK6HCXL86":
-            codul = "6291108735411"
-        elif line.get('sku', '') == "PMPE7SEBBAN4ZPP211":
-            codul = "6290360599120"
-        elif line.get('sku', '') == "TYBO6S9ZD26OA6NI63":
-            codul = "6290360598888"
-        elif line.get('sku', '') == "TYB46RAYZ8NJKLLI50":
-            codul = "6290362345749"
-        elif line.get('sku', '') == "776291108737194":
-            codul = "6291108737194"
-        elif line.get('sku', '') == "PMPGPLCV5FBWOBKL66":
-            codul = "6290306595771"
-        elif line.get('sku', '') == "TYB50R0MDLQTMSGA13":
-            codul = "6290362345749"
-        elif line.get('sku', '') == "TYBMF5JUXY6R2ILI26":
-            codul = "6290362345749"
-        elif line.get('sku', '') == "TYBG2PCBBTTXM2Z558":
-            codul = "6298043160865"
-        elif line.get('sku', '') == "TYBOOEG4YXK6HCXL86":
-            codul = "6291108735411"
-        elif line.get('sku', '') == "TYBUZOW2O04GCF0H47":
-            codul = "6290306595771"
-        elif line.get('sku', '') == "DH-6290362340362":
-            codul = "6290362340362"
-        elif line.get('sku', '') == "DH-6291107456485":
-            codul = "6291107456485"
-        elif line.get('sku', '') == "DH-6290362345749":
-            codul = "6290362345749"
-        elif line.get('sku', '') == "TYB50R0MDLQTMSGA13":
-            codul = "6290362345749"
-        elif line.get('sku', '') == "344259RYI9KM4NWZ":
-            codul = "6290362340362"
-        elif line.get('sku', '') == "TYBDVN19MS50NE4L05":
-            codul = "6291108737194"
-        elif line.get('sku', '') == "PMPNUJML9VHN1WSL78":
-            codul = "6290362346548"
-        elif line.get('sku', '') == "TYBY6WXHAX51S4K146":
-            codul = "6290362346548"
-        elif line.get('sku', '') == "TYBO6S9ZD26OA6NI63":
-            codul = "6290360598888"
-        elif line.get('sku', '') == "TYBZTU26IL7M50OR26":
-            codul = "6290360599168"
-        elif line.get('sku', '') == "DH-6295199802700":
-            codul = "6295199802700"
-        elif line.get('sku', '') == "DH-6294015181272":
-            codul = "6294015181272"
-        elif line.get('sku', '') == "DH-6291108738504":
-            codul = "6291108738504"
-        elif line.get('sku', '') == "DH-6290360598918":
-            codul = "6290360598918"
-        elif line.get('sku', '') == "899365NXPSOQXOR5":
-            codul = "6290360599113"
-        elif line.get('sku', '') == "344259RYI9KM4NWZ":
-            codul = "6290362340362"
-        elif line.get('sku', '') == "DH-6290362340638":
-            codul = "6290362340638"
-        elif line.get('sku', '') == "TYBC9FYOAYWMH5V824":
-            codul = "6298043160865"
-        elif line.get('sku', '') == "2992155993566":
-            codul = "6290362349679"
-        elif line.get('sku', '') == "54512289WHIP1":
-            codul = "6290362349648"
-        elif line.get('sku', '') == "PMPX7MWI02JJOZ5O03":
-            codul = "6290360595764"
-        elif line.get('sku', '') == "PMPCHUVPFHKM851K80":
-            codul = "6290362340638"
-        elif line.get('sku', '') == "4064666318097":
-            codul = "1100011127"
-        elif line.get('sku', '') == "TYBVLGRVD5MIVGV049":
-            codul = "6290360598901"
-        elif line.get('sku', '') == "TYB1LV9CP4QBMKDL08":
-            codul = "6298043160964"
-        elif line.get('sku', '') == "PMPIHBSEOOZSJJB821":
-            codul = "6290362344506"
-        elif line.get('sku', '') == "PMP9V4UX54QSMIVM71":
-            codul = "6290362346531"
-        elif line.get('sku', '') == "TYBNTUAF3RG4369H97":
-            codul = "6291108737194"
-        elif line.get('sku', '') == "TYBNTUAF3RG4369H97":
-            codul = "6291108730515"
-        elif line.get('sku', '') == "TYBN0O65AFCYAWO087":
-            codul = "6298043160964"
-        elif line.get('sku', '') == "TYB61GZIOG8D9CHN23":
-            codul = "6298043160964"
-        elif line.get('sku', '') == "TYC14OQK3N169892658027912":
-            codul = "6291108738290"
-
-
-   
-         
-         
-        
+        sku = line.get('sku', '')
+        codul = SKU_REMAP.get(sku)
+        if codul is None:
+            # codul = line.get('sku', '')
+            codul = line.get('merchantSku', '')
+            if codul == "merchantSku":
+                codul = sku
+
         products.append({
             # 'code': line.get('sku', ''),
             # 'code': line.get('merchantSku', ''),
             'code': codul,
             'name': line.get('productName', ''),
-            'productDescription': f"Numar comanda Trendyol:{order.get('orderNumber', '')}",
+            'productDescription': product_description,
             'measuringUnitName': 'buc',
-            'currency': order.get('currencyCode', 'RON'),
+            'currency': product_currency,
             
             
             # pt factura in euro
@@ -1201,25 +1369,11 @@ def generate_invoice_data_from_order(order, user, use_gestiune=True):
     # Postal code lookup
     if postal_code:
         try:
-            headers = {
-                'User-Agent':
-                'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }
-            response = requests.get(
-                f'https://www.coduripostale.net/{postal_code}',
-                headers=headers,
-                timeout=10)
-            if response.status_code == 200:
-                soup = BeautifulSoup(response.content, 'html.parser')
-                table = soup.find('table')
-                if table:
-                    rows = table.find_all('tr')
-                    if len(rows) > 1:
-                        cols = rows[1].find_all('td')
-                        if len(cols) >= 4:
-                            if not city:
-                                city = cols[2].text.strip()
-                            county = cols[3].text.strip()
+            location = fetch_postal_code_location(postal_code)
+            if location:
+                if not city:
+                    city = location['city']
+                county = location['county']
         except Exception as e:
             print(f"[DEBUG] Postal code lookup error in bulk: {str(e)}")
             pass
@@ -1230,16 +1384,8 @@ def generate_invoice_data_from_order(order, user, use_gestiune=True):
     is_oss = order_currency != 'RON'
 
     # Get series name from SmartBill
-    series_name = 'SERIE_FACTURA'
-    try:
-        smartbill_service = get_smartbill_service()
-        series_result = smartbill_service.get_document_series('f')
-        if series_result and 'list' in series_result and len(
-                series_result['list']) > 0:
-            first_series = series_result['list'][0]
-            series_name = first_series.get('name', series_name)
-    except:
-        pass
+    if series_name is None:
+        series_name = get_invoice_series_name(get_smartbill_service())
 
     # Add -OSS suffix to series name for non-RON currencies
     if is_oss:
@@ -1287,6 +1433,62 @@ def generate_invoice_data_from_order(order, user, use_gestiune=True):
     return invoice_data
 
 
+# Concurrent SmartBill/Trendyol calls per bulk request. Kept low because
+# SmartBill rate-limits API calls per account.
+BULK_WORKERS = 4
+
+# Largest page size the Trendyol orders API accepts
+ORDERS_PAGE_SIZE = 200
+
+
+def iter_order_pages(trendyol_service, **filters):
+    """
+    Yield (orders, error) for each page of Trendyol orders matching the
+    filters, in page order, stopping after the first short page or error.
+    When the first page tells how many pages there are, the rest are
+    fetched BULK_WORKERS at a time, so a caller that stops iterating once
+    it has enough orders skips the remaining requests.
+
+    The bulk endpoints select orders by their invoiceLink, so a SKU-filtered
+    walk starts from a fresh fetch rather than a history cached by this
+    worker before another worker uploaded invoices. Later pages reuse it.
+    """
+
+    def fetch_page(page):
+        return trendyol_service.get_orders(page=page,
+                                           size=ORDERS_PAGE_SIZE,
+                                           fresh=page == 0,
+                                           **filters)
+
+    result = fetch_page(0)
+    if 'error' in result:
+        yield None, result['error']
+        return
+    content = result.get('content', [])
+    yield content, None
+    if len(content) < ORDERS_PAGE_SIZE:
+        return
+
+    total_pages = result.get('totalPages')
+    # No page count in the response: walk the pages one by one
+    batch_size = BULK_WORKERS if total_pages is not None else 1
+    page = 1
+    with ThreadPoolExecutor(max_workers=batch_size) as executor:
+        while total_pages is None or page < total_pages:
+            last = page + batch_size
+            if total_pages is not None:
+                last = min(last, total_pages)
+            for result in executor.map(fetch_page, range(page, last)):
+                if 'error' in result:
+                    yield None, result['error']
+                    return
+                content = result.get('content', [])
+                yield content, None
+                if len(content) < ORDERS_PAGE_SIZE:
+                    return
+            page = last
+
+
 @app.route('/api/bulk-send-to-smartbill', methods=['POST'])
 @login_required
 def bulk_send_to_smartbill():
@@ -1312,108 +1514,143 @@ def bulk_send_to_smartbill():
         sku = request_data.get('sku', '')
 
         user = current_user._get_current_object()
-        trendyol_service = TrendyolService(user.trendyol_api_key,
-                                           user.trendyol_api_secret,
-                                           user.trendyol_supplier_id)
-
-        # Get all order IDs that already have invoices in the database for current user
-        import sqlite3
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute('SELECT order_id FROM order_invoices WHERE user_id = ?',
-                  (current_user.id, ))
-        existing_invoice_orders = set(row[0] for row in c.fetchall())
-        conn.close()
-
-        # Get orders with filters applied
-        all_orders = []
-        page = 0
-        while True:
-            result = trendyol_service.get_orders(page=page,
-                                                 size=200,
-                                                 status=status,
-                                                 start_date=start_date,
-                                                 end_date=end_date,
-                                                 order_number=order_number,
-                                                 sku=sku)
-            if 'error' in result:
-                return jsonify(
-                    {'error':
-                     f'Failed to fetch orders: {result["error"]}'}), 500
-
-            orders = result.get('content', [])
-            if not orders:
-                break
+        trendyol_service = get_trendyol_service()
 
-            all_orders.extend(orders)
+        # Collect orders that:
+        # 1. Don't have an invoice uploaded to Trendyol (no invoiceLink)
+        # 2. Don't have an invoice already created in our database
+        # page by page, and stop fetching once there are enough of them.
+        # Kept as (order number as str, order) pairs, converted once here.
+        orders_to_process = []
+        pages = iter_order_pages(trendyol_service,
+                                 status=status,
+                                 start_date=start_date,
+                                 end_date=end_date,
+                                 order_number=order_number,
+                                 sku=sku)
+        for orders, error in pages:
+            if error:
+                return jsonify({'error':
+                                f'Failed to fetch orders: {error}'}), 500
+
+            candidates = [
+                (str(order.get('orderNumber', '')), order)
+                for order in orders if not order.get('invoiceLink')
+            ]
+            if not candidates:
+                continue
 
-            if len(orders) < 200:
+            # The UNIQUE(user_id, order_id) index answers this directly
+            # instead of loading every invoice the user has ever created.
+            with db_conn() as conn:
+                existing_invoice_orders = {
+                    row[0]
+                    for row in conn.execute(
+                        '''
+                        SELECT order_id FROM order_invoices
+                        WHERE user_id = ?
+                          AND order_id IN (SELECT value FROM json_each(?))
+                    ''', (current_user.id,
+                          app.json.dumps([n for n, _ in candidates])))
+                }
+
+            orders_to_process.extend(
+                (number, order) for number, order in candidates
+                if number not in existing_invoice_orders)
+            if len(orders_to_process) >= order_count:
                 break
-            page += 1
-
-        # Filter orders that:
-        # 1. Don't have an invoice already created in our database
-        # 2. Don't have an invoice uploaded to Trendyol (no invoiceLink)
-        orders_without_invoice = [
-            order for order in all_orders
-            if str(order.get('orderNumber', '')) not in existing_invoice_orders
-            and not order.get('invoiceLink')
-        ]
+        pages.close()
 
         # Limit to requested order count
-        orders_to_process = orders_without_invoice[:order_count]
+        orders_to_process = orders_to_process[:order_count]
 
         successful = 0
         failed = 0
         errors = []
+        # (user_id, order_id, series, number) rows written in one
+        # transaction once the SmartBill calls are done
+        invoice_rows = []
+        conflicts = []
 
         smartbill_service = get_smartbill_service()
-
-        for order in orders_to_process:
-            try:
-                invoice_data = generate_invoice_data_from_order(order, user)
-                result = smartbill_service.create_invoice(invoice_data)
+        series_name = get_invoice_series_name(smartbill_service)
+        user_id = current_user.id
+
+        # Runs in the worker threads, so it must not touch current_user
+        def create_invoice_for(order_number, order):
+            invoice_data = generate_invoice_data_from_order(
+                order, user, series_name=series_name)
+            result = smartbill_service.create_invoice(invoice_data)
+            if 'error' not in result:
+                series = result.get('series', '')
+                number = result.get('number', '')
+                if series and number and order_number:
+                    invoice_rows.append(
+                        (user_id, order_number, series, number))
+            return result
+
+        prefetch_postal_codes([order for _, order in orders_to_process])
+
+        executor = ThreadPoolExecutor(max_workers=BULK_WORKERS)
+        try:
+            futures = [
+                executor.submit(create_invoice_for, order_number, order)
+                for order_number, order in orders_to_process
+            ]
+            for (order_number, _), future in zip(orders_to_process, futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed += 1
+                    errors.append(f"Order {order_number or 'N/A'}: {str(e)}")
+                    continue
 
                 if 'error' in result:
                     failed += 1
                     errors.append(
-                        f"Order {order.get('orderNumber', 'N/A')}: {result['error']}"
-                    )
+                        f"Order {order_number or 'N/A'}: {result['error']}")
                 else:
                     successful += 1
-                    # Save invoice info to database
-                    series = result.get('series', '')
-                    number = result.get('number', '')
-                    order_number = order.get('orderNumber', '')
-
-                    if series and number and order_number:
-                        import sqlite3
-                        conn = sqlite3.connect('users.db')
-                        c = conn.cursor()
-                        # First, delete any existing invoice for this user/order
-                        c.execute(
-                            'DELETE FROM order_invoices WHERE user_id = ? AND order_id = ?',
-                            (current_user.id, order_number))
-                        # Then insert the new invoice
-                        c.execute(
-                            '''INSERT INTO order_invoices 
-                                    (user_id, order_id, invoice_series, invoice_number) 
-                                    VALUES (?, ?, ?, ?)''',
-                            (current_user.id, order_number, series, number))
-                        conn.commit()
-                        conn.close()
-            except Exception as e:
-                failed += 1
-                errors.append(
-                    f"Order {order.get('orderNumber', 'N/A')}: {str(e)}")
-                continue
+        finally:
+            # Invoices already issued in SmartBill must be recorded even if
+            # the request is interrupted, or a retry would issue them twice.
+            # Calls in flight are allowed to finish; queued ones are dropped.
+            executor.shutdown(wait=True, cancel_futures=True)
+            if invoice_rows:
+                with db_conn() as conn:
+                    for row in invoice_rows:
+                        existing = record_invoice(conn, *row)
+                        if existing:
+                            conflicts.append({
+                                'orderNumber': row[1],
+                                'series': existing[0],
+                                'number': existing[1],
+                                'newSeries': row[2],
+                                'newNumber': row[3]
+                            })
+                    conn.commit()
+
+        if successful:
+            invalidate_document_series()
+
+        # Issued in SmartBill but already invoiced by a concurrent request.
+        # Listed first so the limit below never hides them.
+        successful -= len(conflicts)
+        failed += len(conflicts)
+        errors[:0] = [
+            f"Order {conflict['orderNumber']}: already invoiced as "
+            f"{conflict['series']}-{conflict['number']}; duplicate "
+            f"{conflict['newSeries']}-{conflict['newNumber']} must be "
+            f"reversed" for conflict in conflicts
+        ]
 
         return jsonify({
             'success': True,
             'total': len(orders_to_process),
             'successful': successful,
             'failed': failed,
-            'errors': errors[:10]  # Limit to first 10 errors
+            'errors': errors[:10],  # Limit to first 10 errors
+            'conflicts': conflicts
         })
 
     except Exception as e:
@@ -1445,71 +1682,55 @@ def bulk_upload_to_trendyol():
         sku = request_data.get('sku', '')
 
         # Get all order-invoice mappings from database for current user
-        import sqlite3
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute(
-            'SELECT order_id, invoice_series, invoice_number FROM order_invoices WHERE user_id = ?',
-            (current_user.id, ))
-        invoice_mappings = {
-            row[0]: {
-                'series': row[1],
-                'number': row[2]
+        with db_conn() as conn:
+            c = conn.cursor()
+            c.execute(
+                'SELECT order_id, invoice_series, invoice_number FROM order_invoices WHERE user_id = ?',
+                (current_user.id, ))
+            invoice_mappings = {
+                row[0]: {
+                    'series': row[1],
+                    'number': row[2]
+                }
+                for row in c.fetchall()
             }
-            for row in c.fetchall()
-        }
-        conn.close()
 
         if not invoice_mappings:
             return jsonify(
                 {'error': 'No SmartBill invoices found in database'}), 400
 
-        user = current_user._get_current_object()
-        trendyol_service = TrendyolService(user.trendyol_api_key,
-                                           user.trendyol_api_secret,
-                                           user.trendyol_supplier_id)
-
-        # Get orders with filters applied
-        all_orders = []
-        page = 0
-        while True:
-            result = trendyol_service.get_orders(page=page,
-                                                 size=200,
-                                                 status=status,
-                                                 start_date=start_date,
-                                                 end_date=end_date,
-                                                 order_number=order_number,
-                                                 sku=sku)
-            if 'error' in result:
-                return jsonify(
-                    {'error':
-                     f'Failed to fetch orders: {result["error"]}'}), 500
-
-            orders = result.get('content', [])
-            if not orders:
-                break
-
-            all_orders.extend(orders)
+        trendyol_service = get_trendyol_service()
 
-            if len(orders) < 200:
+        # Collect orders that have SmartBill invoices but no Trendyol
+        # upload, and stop fetching once there are enough of them
+        orders_to_upload = []
+        pages = iter_order_pages(trendyol_service,
+                                 status=status,
+                                 start_date=start_date,
+                                 end_date=end_date,
+                                 order_number=order_number,
+                                 sku=sku)
+        for orders, error in pages:
+            if error:
+                return jsonify({'error':
+                                f'Failed to fetch orders: {error}'}), 500
+
+            for order in orders:
+                order_number = order.get('orderNumber')
+                if order_number in invoice_mappings and not order.get(
+                        'invoiceLink'):
+                    orders_to_upload.append({
+                        'order':
+                        order,
+                        'invoice':
+                        invoice_mappings[order_number]
+                    })
+            if len(orders_to_upload) >= upload_count:
                 break
-            page += 1
-
-        # Filter orders that have SmartBill invoices but no Trendyol upload
-        orders_to_upload_all = []
-        for order in all_orders:
-            order_number = order.get('orderNumber')
-            if order_number in invoice_mappings and not order.get(
-                    'invoiceLink'):
-                orders_to_upload_all.append({
-                    'order':
-                    order,
-                    'invoice':
-                    invoice_mappings[order_number]
-                })
+        pages.close()
 
         # Limit to requested upload count
-        orders_to_upload = orders_to_upload_all[:upload_count]
+        orders_to_upload = orders_to_upload[:upload_count]
 
         successful = 0
         failed = 0
@@ -1517,30 +1738,37 @@ def bulk_upload_to_trendyol():
 
         smartbill_service = get_smartbill_service()
 
-        for item in orders_to_upload:
-            filepath = None
-            try:
+        def upload_invoice_for(item):
+            order = item['order']
+            invoice = item['invoice']
+            package_id = str(order.get('id', '')).strip()
+            series = invoice['series']
+            number = invoice['number']
+
+            # Download PDF from SmartBill; a SmartBillError is counted as
+            # a failure for this order below
+            pdf_content = smartbill_service.get_invoice_pdf(series, number)
+            filename = f"invoice_{package_id}_{series}_{number}.pdf"
+
+            return trendyol_service.upload_invoice_file(package_id,
+                                                        pdf_content,
+                                                        filename=filename)
+
+        with ThreadPoolExecutor(max_workers=BULK_WORKERS) as executor:
+            futures = [
+                executor.submit(upload_invoice_for, item)
+                for item in orders_to_upload
+            ]
+            for item, future in zip(orders_to_upload, futures):
                 order = item['order']
-                invoice = item['invoice']
-                package_id = str(order.get('id', '')).strip()
-                series = invoice['series']
-                number = invoice['number']
-
-                # Download PDF from SmartBill
-                pdf_content = smartbill_service.get_invoice_pdf(series, number)
-
-                if isinstance(pdf_content, dict) and 'error' in pdf_content:
+                try:
+                    result = future.result()
+                except Exception as e:
                     failed += 1
                     errors.append(
-                        f"Order {order.get('orderNumber', 'N/A')}: {pdf_content['error']}"
-                    )
+                        f"Order {order.get('orderNumber', 'N/A')}: {str(e)}")
                     continue
 
-                filename = f"invoice_{package_id}_{series}_{number}.pdf"
-
-                result = trendyol_service.upload_invoice_file(
-                    package_id, pdf_content, filename=filename)
-
                 if 'error' in result:
                     failed += 1
                     errors.append(
@@ -1549,11 +1777,6 @@ def bulk_upload_to_trendyol():
                 else:
                     successful += 1
 
-            except Exception as e:
-                failed += 1
-                errors.append(
-                    f"Order {order.get('orderNumber', 'N/A')}: {str(e)}")
-
         return jsonify({
             'success': True,
             'total': len(orders_to_upload),
@@ -1567,4 +1790,14 @@ def bulk_upload_to_trendyol():
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Development server only; production runs `gunicorn app:app` (see
+    # gunicorn.conf.py), whose master process runs the invoice cleanup.
+    # The debugger allows code execution, so it is opt-in via FLASK_DEBUG=1.
+    debug = os.getenv('FLASK_DEBUG') == '1'
+    # With the reloader, this module runs in a watcher process too; only
+    # the process actually serving requests (WERKZEUG_RUN_MAIN) cleans up
+    if not debug or os.getenv('WERKZEUG_RUN_MAIN') == 'true':
+        start_invoice_cleanup_scheduler()
+    app.run(host='0.0.0.0',
+            port=5000,
+            debug=debug)
@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+import time
+
+_redis_client = None
+
+
+class TTLCache:
+    """
+    Thread-safe in-process cache whose entries expire after ttl seconds.
+    When maxsize is reached, expired entries are purged first and then the
+    oldest entry is evicted. With weigh and maxweight, entries are also
+    evicted oldest first to keep the sum of weigh(value) within maxweight,
+    and a value heavier than maxweight is not stored.
+    """
+
+    def __init__(self, ttl, maxsize=1024, weigh=None, maxweight=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.weigh = weigh
+        self.maxweight = maxweight
+        self._data = {}
+        self._weight = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value, _ = item
+            if expires_at < time.monotonic():
+                self._pop(key)
+                return default
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        weight = self.weigh(value) if self.weigh else 0
+        with self._lock:
+            self._pop(key)
+            if self.maxweight is not None and weight > self.maxweight:
+                return
+            if len(self._data) >= self.maxsize:
+                self._evict()
+            if self.maxweight is not None:
+                while self._data and self._weight + weight > self.maxweight:
+                    self._pop(next(iter(self._data)))
+            self._data[key] = (expires_at, value, weight)
+            self._weight += weight
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def delete_where(self, predicate):
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weight = 0
+
+    def _pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._weight -= item[2]
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [k for k, (exp, _, _) in self._data.items() if exp < now]:
+            self._pop(key)
+        if len(self._data) >= self.maxsize:
+            # dicts keep insertion order, so the first key is the oldest
+            self._pop(next(iter(self._data)))
+
+
+class RedisCache:
+    """
+    Cache storing JSON-encoded values in Redis, so every worker process
+    shares the same entries. Redis errors are treated as cache misses.
+    """
+
+    def __init__(self, client, prefix, ttl):
+        import redis
+
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self._error = redis.RedisError
+
+    def get(self, key, default=None):
+        try:
+            raw = self.client.get(self.prefix + key)
+        except self._error:
+            return default
+        return default if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.client.setex(self.prefix + key,
+                              self.ttl if ttl is None else ttl,
+                              json.dumps(value))
+        except self._error:
+            pass
+
+    def delete(self, key):
+        try:
+            self.client.delete(self.prefix + key)
+        except self._error:
+            pass
+
+
+def get_redis_client():
+    """
+    Return the process-wide Redis client, or None when REDIS_URL is not set.
+    """
+    global _redis_client
+    redis_url = os.getenv('REDIS_URL')
+    if not redis_url:
+        return None
+    if _redis_client is None:
+        import redis
+        _redis_client = redis.Redis.from_url(redis_url)
+    return _redis_client
+
+
+def shared_cache(prefix, ttl, maxsize=1024):
+    """
+    Return a Redis-backed cache when Redis is configured, otherwise an
+    in-process TTLCache. Keys must be strings and values JSON-serializable.
+    """
+    client = get_redis_client()
+    if client is not None:
+        return RedisCache(client, prefix, ttl)
+    return TTLCache(ttl, maxsize=maxsize)
@@ -0,0 +1,22 @@
+import os
+
+# Production server settings, picked up automatically by `gunicorn app:app`.
+# The app spends most of its time waiting on SQLite, Trendyol, SmartBill and
+# coduripostale.net, so gevent workers let one process serve many requests
+# concurrently; the worker monkey-patches sockets before the app is loaded.
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '4'))
+worker_class = 'gevent'
+worker_connections = 200
+
+# Bulk SmartBill/Trendyol runs can take minutes
+timeout = 300
+
+
+def when_ready(server):
+    # One invoice cleanup thread for the whole server, in the master. It is
+    # not monkey-patched by gevent, so the thread is a real OS thread whose
+    # directory scan never stalls a worker, and worker restarts don't
+    # trigger another scan.
+    from invoice_cleanup import start_invoice_cleanup_scheduler
+    start_invoice_cleanup_scheduler()
@@ -0,0 +1,49 @@
+import http.cookiejar
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def create_session():
+    """
+    A requests session with the retry policy shared by the Trendyol and
+    SmartBill API clients.
+    """
+    session = requests.Session()
+    # The session is shared by every user of the process, so it must not
+    # remember cookies: one tenant's Set-Cookie (a JSESSIONID or a load
+    # balancer cookie) would otherwise be sent on the next tenant's
+    # requests. Only the connection pool is shared.
+    session.cookies.set_policy(
+        http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    # Failed connection attempts are retried for every method: the request
+    # was never sent, so this is safe even for POSTs that create invoices.
+    # Rate-limit and server errors are only retried for GETs, since a POST
+    # may have been processed before the error. Waits grow exponentially
+    # with jitter, and a Retry-After header on 429/503 is honoured.
+    retries = Retry(total=3,
+                    connect=3,
+                    read=0,
+                    status=3,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=frozenset({'GET'}),
+                    backoff_factor=1,
+                    backoff_max=30,
+                    backoff_jitter=0.5,
+                    respect_retry_after_header=True,
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=10,
+                          pool_maxsize=50,
+                          max_retries=retries)
+    session.mount('https://', adapter)
+    return session
+
+
+def decode_json(response):
+    """Decode a response body with orjson, raising what response.json() would."""
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError as e:
+        raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos)
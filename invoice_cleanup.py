@@ -0,0 +1,66 @@
+import os
+import threading
+import time
+
+
+def cleanup_old_invoices(max_age_days=30):
+    """
+    Delete invoice PDFs older than max_age_days from static/invoices directory.
+    Runs periodically from the cleanup thread to manage storage.
+    """
+    try:
+        invoices_dir = os.path.join(os.getcwd(), 'static', 'invoices')
+
+        if not os.path.exists(invoices_dir):
+            return
+
+        cutoff_time = time.time() - (max_age_days * 24 * 60 * 60)
+        deleted_count = 0
+
+        # scandir caches the file type from the directory listing, so only
+        # the mtime needs a stat call per PDF
+        with os.scandir(invoices_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.pdf'):
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+
+                if entry.stat().st_mtime < cutoff_time:
+                    try:
+                        os.remove(entry.path)
+                        deleted_count += 1
+                        print(f"[CLEANUP] Deleted old invoice: {entry.name}")
+                    except Exception as e:
+                        print(f"[CLEANUP] Failed to delete {entry.name}: {e}")
+
+        if deleted_count > 0:
+            print(
+                f"[CLEANUP] Deleted {deleted_count} invoice(s) older than {max_age_days} days"
+            )
+
+    except Exception as e:
+        print(f"[CLEANUP] Error during invoice cleanup: {e}")
+
+
+def start_invoice_cleanup_scheduler(interval_hours=24):
+    """
+    Run cleanup_old_invoices once every interval_hours in a daemon thread,
+    so the directory scan never blocks a request.
+
+    Call it once per deployment from a process that is not monkey-patched
+    by gevent: gunicorn's master (see when_ready in gunicorn.conf.py) or the
+    development server. In a gevent worker the thread would be a greenlet,
+    and each worker would run its own sweeper.
+    """
+
+    def run():
+        while True:
+            cleanup_old_invoices()
+            time.sleep(interval_hours * 60 * 60)
+
+    thread = threading.Thread(target=run,
+                              name='invoice-cleanup',
+                              daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,31 @@
+import orjson
+from flask.json.provider import DefaultJSONProvider
+
+# datetime objects are handed to Flask's default() so they keep the HTTP
+# date format jsonify has always produced; int dict keys become strings
+# like they do with the stdlib encoder
+_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON provider that serializes with orjson, used by jsonify and
+    request.get_json. Types orjson does not handle natively (Decimal, UUID,
+    dates, ...) fall back to Flask's default conversion. Output is compact
+    and keeps dict insertion order.
+    """
+
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default,
+                            option=_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=_OPTIONS),
+            mimetype=self.mimetype)
@@ -4,64 +4,79 @@ from user_manager import UserManager
 
 def migrate_database():
     db_path = 'users.db'
-    
+
     if not os.path.exists(db_path):
         print("Database doesn't exist yet, creating fresh...")
         um = UserManager(db_path)
         print("Database created with new schema")
         return
-    
+
+    # One connection and one transaction for the whole migration: the
+    # schema changes below, the tables UserManager creates, the admin user
+    # and the re-encrypted credentials are committed together at the end,
+    # so a failure part way leaves the database as it was.
     conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    c.execute("PRAGMA table_info(users)")
-    columns = [col[1] for col in c.fetchall()]
-    
-    if 'role' not in columns:
-        print("Adding 'role' column to users table...")
-        c.execute("ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'user'")
-        conn.commit()
-        print("Role column added successfully")
-    else:
-        print("Role column already exists")
-    
-    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='order_invoices'")
-    if not c.fetchone():
-        print("Creating order_invoices table...")
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS order_invoices (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id TEXT UNIQUE NOT NULL,
-                invoice_series TEXT NOT NULL,
-                invoice_number TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    try:
+        c = conn.cursor()
+        c.execute("BEGIN")
+
+        c.execute("PRAGMA table_info(users)")
+        columns = [col[1] for col in c.fetchall()]
+
+        if 'role' not in columns:
+            print("Adding 'role' column to users table...")
+            c.execute("ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'user'")
+            print("Role column added successfully")
+        else:
+            print("Role column already exists")
+
+        c.execute("PRAGMA table_info(order_invoices)")
+        invoice_columns = [col[1] for col in c.fetchall()]
+
+        if invoice_columns and 'user_id' not in invoice_columns:
+            # The old table had a global UNIQUE(order_id) and no owner, so it
+            # cannot be altered in place. Keep its rows aside and let
+            # UserManager create the per-user table with UNIQUE(user_id, order_id).
+            print("Moving old order_invoices table to order_invoices_legacy...")
+            c.execute("ALTER TABLE order_invoices RENAME TO order_invoices_legacy")
+            print("Old invoice rows kept in order_invoices_legacy; assign them to users manually")
+        elif invoice_columns:
+            print("order_invoices table already exists")
+        else:
+            print("order_invoices table will be created")
+
+        # Creates the missing tables and indexes; on a connection passed in,
+        # UserManager leaves committing to us
+        um = UserManager(db_path, conn=conn)
+
+        c.execute("SELECT id FROM users WHERE username = 'admin'")
+        if not c.fetchone():
+            print("Creating admin user...")
+            success = um.create_user(
+                username='admin',
+                password='trendyol1',
+                role='admin'
             )
-        ''')
-        conn.commit()
-        print("order_invoices table created successfully")
-    else:
-        print("order_invoices table already exists")
-    
-    conn.close()
-    
-    um = UserManager(db_path)
-    
-    c = sqlite3.connect(db_path).cursor()
-    c.execute("SELECT id FROM users WHERE username = 'admin'")
-    if not c.fetchone():
-        print("Creating admin user...")
-        success = um.create_user(
-            username='admin',
-            password='trendyol1',
-            role='admin'
-        )
-        if success:
-            print("Admin user created successfully (username: admin, password: trendyol1)")
+            if success:
+                print("Admin user created successfully (username: admin, password: trendyol1)")
+            else:
+                print("Failed to create admin user")
         else:
-            print("Failed to create admin user")
-    else:
-        print("Admin user already exists")
-    
+            print("Admin user already exists")
+
+        updated, unreadable = um.reencrypt_credentials()
+        print(f"Re-encrypted credentials of {updated} user(s) with AES-GCM")
+        if unreadable:
+            print(f"Could not decrypt the credentials of user(s) "
+                  f"{', '.join(map(str, unreadable))}; they were left as they are")
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
     print("\nMigration complete!")
 
 if __name__ == '__main__':
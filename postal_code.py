@@ -0,0 +1,45 @@
+import html
+import re
+
+from selectolax.lexbor import LexborHTMLParser
+
+
+# The result is the second row of the first table on the page (the first
+# is the header); city and county are its 3rd and 4th cells. The row is
+# only looked for inside the first table, so a page whose first table has
+# no result row does not pick up a row from a later table.
+_POSTAL_TABLE_RE = re.compile(rb'<table\b.*?</table>', re.S | re.I)
+_POSTAL_ROW_RE = re.compile(rb'<tr\b.*?<tr\b[^>]*>(.*?)</tr>', re.S | re.I)
+_POSTAL_CELL_RE = re.compile(rb'<td\b[^>]*>(.*?)</td>', re.S | re.I)
+_TAG_RE = re.compile(rb'<[^>]+>')
+
+
+def _cell_text(cell):
+    return html.unescape(_TAG_RE.sub(b'', cell).decode('utf-8',
+                                                         'replace')).strip()
+
+
+def parse_postal_code_page(content):
+    """
+    Extract {'city': ..., 'county': ...} from a coduripostale.net page, or
+    None. A regex scan handles the expected markup; selectolax is only used
+    when that misses, in case the page layout changes.
+    """
+    table_match = _POSTAL_TABLE_RE.search(content)
+    match = table_match and _POSTAL_ROW_RE.search(table_match.group(0))
+    if match:
+        cols = _POSTAL_CELL_RE.findall(match.group(1))
+        if len(cols) >= 4:
+            return {'city': _cell_text(cols[2]), 'county': _cell_text(cols[3])}
+
+    table = LexborHTMLParser(content).css_first('table')
+    if table:
+        rows = table.css('tr')
+        if len(rows) > 1:
+            cols = rows[1].css('td')
+            if len(cols) >= 4:
+                return {
+                    'city': cols[2].text().strip(),
+                    'county': cols[3].text().strip()
+                }
+    return None
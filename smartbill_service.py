@@ -1,28 +1,101 @@
+import logging
 import requests
 import base64
 import os
 from datetime import datetime
+from http_session import create_session, decode_json
+
+logger = logging.getLogger(__name__)
+
+
+def _body_start(response, limit):
+    """The first limit bytes of a response body, decoded without the rest."""
+    return response.content[:limit].decode('utf-8', 'replace')
+
+
+class SmartBillError(Exception):
+    """
+    Raised by calls whose success value is not a dict (the invoice PDF).
+    status is the HTTP status to report to our own client.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# Shared by every service instance so connections to the SmartBill API are
+# kept alive across requests. Credentials are passed per call in headers.
+_session = create_session()
+
 
 class SmartBillService:
     BASE_URL = "https://ws.smartbill.ro/SBORO/api"
     
+    # Sent with the Authorization header on every call; the PDF download
+    # asks for a binary body instead of JSON
+    _BASE_HEADERS = {
+        'Accept': 'application/json',
+        'Content-Type': 'application/json'
+    }
+    _PDF_HEADERS = {
+        'Accept': 'application/octet-stream',
+        'Content-Type': 'application/xml'
+    }
+    
+    # Error messages by HTTP status for each call, formatted with the
+    # response body as {text} (or its first 200 characters as {short}).
+    # Other statuses get the generic "SmartBill API error" message.
+    SERIES_ERRORS = {
+        401: 'Invalid SmartBill credentials',
+        403: 'Access forbidden - check your SmartBill plan or rate limit'
+    }
+    LIST_ERRORS = {
+        400: 'Bad request - check your parameters: {text}',
+        **SERIES_ERRORS
+    }
+    CREATE_ERRORS = {
+        400: 'Bad request - invalid invoice data: {text}',
+        401: 'Invalid SmartBill credentials (401): {short}',
+        403: 'Access forbidden (403): {short}'
+    }
+    INVOICE_ERRORS = {
+        401: 'Invalid SmartBill credentials',
+        403: 'Access forbidden - check your SmartBill plan or permissions',
+        404: 'Invoice not found: {series}-{number}'
+    }
+    
     def __init__(self, api_token=None, email=None, company_cif=None):
         self.api_token = api_token or os.getenv('SMARTBILL_API_TOKEN')
         self.email = email or os.getenv('SMARTBILL_EMAIL')
         self.company_cif = company_cif or os.getenv('SMARTBILL_COMPANY_CIF')
+        self._auth_header = None
+        if self.email and self.api_token:
+            credentials = f"{self.email}:{self.api_token}"
+            encoded_credentials = base64.b64encode(credentials.encode()).decode()
+            self._auth_header = f'Basic {encoded_credentials}'
     
     def _create_headers(self):
-        if not self.email or not self.api_token:
+        if not self._auth_header:
             return None
         
-        credentials = f"{self.email}:{self.api_token}"
-        encoded_credentials = base64.b64encode(credentials.encode()).decode()
-        
-        return {
-            'Authorization': f'Basic {encoded_credentials}',
-            'Accept': 'application/json',
-            'Content-Type': 'application/json'
-        }
+        return {'Authorization': self._auth_header, **self._BASE_HEADERS}
+    
+    def _error_message(self, response, messages, **values):
+        template = messages.get(response.status_code)
+        if template is None:
+            return f'SmartBill API error: {response.status_code} - {_body_start(response, 200)}'
+        if '{text}' in template:
+            values['text'] = response.text
+        if '{short}' in template:
+            values['short'] = _body_start(response, 200)
+        return template.format(**values)
+    
+    def _handle_response(self, response, messages, **values):
+        """The decoded JSON of a 200 response, otherwise an error dict."""
+        if response.status_code == 200:
+            return decode_json(response)
+        return {'error': self._error_message(response, messages, **values)}
     
     def get_document_series(self, document_type='f'):
         """
@@ -47,22 +120,13 @@ class SmartBillService:
         }
         
         try:
-            response = requests.get(
+            response = _session.get(
                 f"{self.BASE_URL}/series",
                 headers=headers,
                 params=params,
                 timeout=10
             )
-            
-            if response.status_code == 200:
-                return response.json()
-            elif response.status_code == 401:
-                return {'error': 'Invalid SmartBill credentials'}
-            elif response.status_code == 403:
-                return {'error': 'Access forbidden - check your SmartBill plan or rate limit'}
-            else:
-                return {'error': f'SmartBill API error: {response.status_code} - {response.text[:200]}'}
-        
+            return self._handle_response(response, self.SERIES_ERRORS)
         except requests.exceptions.RequestException as e:
             return {'error': f'Connection error: {str(e)}'}
     
@@ -95,24 +159,13 @@ class SmartBillService:
             params['issueDate'] = date
         
         try:
-            response = requests.get(
+            response = _session.get(
                 f"{self.BASE_URL}/invoice/list",
                 headers=headers,
                 params=params,
                 timeout=10
             )
-            
-            if response.status_code == 200:
-                return response.json()
-            elif response.status_code == 400:
-                return {'error': f'Bad request - check your parameters: {response.text}'}
-            elif response.status_code == 401:
-                return {'error': 'Invalid SmartBill credentials'}
-            elif response.status_code == 403:
-                return {'error': 'Access forbidden - check your SmartBill plan or rate limit'}
-            else:
-                return {'error': f'SmartBill API error: {response.status_code} - {response.text}'}
-        
+            return self._handle_response(response, self.LIST_ERRORS)
         except requests.exceptions.RequestException as e:
             return {'error': f'Connection error: {str(e)}'}
     
@@ -133,31 +186,30 @@ class SmartBillService:
         if not self.company_cif:
             return {'error': 'Missing company CIF'}
         
-        print(f"[DEBUG] SmartBill create_invoice - email: {self.email}, cif (from DB): {self.company_cif}, api_token present: {bool(self.api_token)}")
-        print(f"[DEBUG] SmartBill create_invoice - companyVatCode in data: {invoice_data.get('companyVatCode', 'NOT SET')}")
-        print(f"[DEBUG] SmartBill create_invoice - seriesName: {invoice_data.get('seriesName', 'NOT SET')}")
+        logger.debug(
+            "SmartBill create_invoice - email: %s, cif (from DB): %s, api_token present: %s",
+            self.email, self.company_cif, bool(self.api_token))
+        logger.debug(
+            "SmartBill create_invoice - companyVatCode in data: %s",
+            invoice_data.get('companyVatCode', 'NOT SET'))
+        logger.debug(
+            "SmartBill create_invoice - seriesName: %s",
+            invoice_data.get('seriesName', 'NOT SET'))
         
         try:
-            response = requests.post(
+            response = _session.post(
                 f"{self.BASE_URL}/invoice",
                 headers=headers,
                 json=invoice_data,
                 timeout=30
             )
             
-            print(f"[DEBUG] SmartBill create_invoice - status: {response.status_code}, response: {response.text[:500]}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "SmartBill create_invoice - status: %s, response: %s",
+                    response.status_code, _body_start(response, 500))
             
-            if response.status_code == 200:
-                return response.json()
-            elif response.status_code == 400:
-                return {'error': f'Bad request - invalid invoice data: {response.text}'}
-            elif response.status_code == 401:
-                return {'error': f'Invalid SmartBill credentials (401): {response.text[:200]}'}
-            elif response.status_code == 403:
-                return {'error': f'Access forbidden (403): {response.text[:200]}'}
-            else:
-                return {'error': f'SmartBill API error: {response.status_code} - {response.text[:200]}'}
-        
+            return self._handle_response(response, self.CREATE_ERRORS)
         except requests.exceptions.RequestException as e:
             return {'error': f'Connection error: {str(e)}'}
     
@@ -170,17 +222,39 @@ class SmartBillService:
             number: Invoice number
         
         Returns:
-            PDF content or error dict
+            PDF content
+
+        Raises:
+            SmartBillError: if the PDF could not be downloaded
         """
-        headers = self._create_headers()
-        if not headers:
-            return {'error': 'Invalid SmartBill credentials (missing email or API token)'}
+        return self._request_invoice_pdf(series, number).content
+
+    def stream_invoice_pdf(self, series, number):
+        """
+        Like get_invoice_pdf, but returns an iterator over the PDF as it
+        arrives instead of reading it into memory first. The connection is
+        released once the iterator is exhausted or closed.
+        """
+        response = self._request_invoice_pdf(series, number, stream=True)
+        return self._stream_pdf(response)
+
+    PDF_CHUNK_SIZE = 64 * 1024
+
+    @classmethod
+    def _stream_pdf(cls, response):
+        try:
+            yield from response.iter_content(chunk_size=cls.PDF_CHUNK_SIZE)
+        finally:
+            response.close()
+
+    def _request_invoice_pdf(self, series, number, stream=False):
+        if not self._auth_header:
+            raise SmartBillError(401, 'Invalid SmartBill credentials (missing email or API token)')
         
         if not self.company_cif:
-            return {'error': 'Missing company CIF'}
+            raise SmartBillError(500, 'Missing company CIF')
         
-        headers['Content-Type'] = 'application/xml'
-        headers['Accept'] = 'application/octet-stream'
+        headers = {'Authorization': self._auth_header, **self._PDF_HEADERS}
         
         params = {
             'cif': self.company_cif,
@@ -189,26 +263,27 @@ class SmartBillService:
         }
         
         try:
-            response = requests.get(
+            response = _session.get(
                 f"{self.BASE_URL}/invoice/pdf",
                 headers=headers,
                 params=params,
-                timeout=10
+                timeout=10,
+                stream=stream
             )
-            
-            if response.status_code == 200:
-                return response.content
-            elif response.status_code == 401:
-                return {'error': 'Invalid SmartBill credentials'}
-            elif response.status_code == 403:
-                return {'error': 'Access forbidden - check your SmartBill plan or permissions'}
-            elif response.status_code == 404:
-                return {'error': f'Invoice not found: {series}-{number}'}
-            else:
-                return {'error': f'SmartBill API error: {response.status_code} - {response.text[:200]}'}
-        
         except requests.exceptions.RequestException as e:
-            return {'error': f'Connection error: {str(e)}'}
+            raise SmartBillError(500, f'Connection error: {str(e)}')
+        
+        if response.status_code == 200:
+            return response
+        
+        try:
+            status = response.status_code
+            raise SmartBillError(
+                status if status in self.INVOICE_ERRORS else 500,
+                self._error_message(response, self.INVOICE_ERRORS,
+                                    series=series, number=number))
+        finally:
+            response.close()
 
     def reverse_invoice(self, series, number, issue_date=None):
         headers = self._create_headers()
@@ -230,23 +305,13 @@ class SmartBillService:
             payload['issueDate'] = datetime.now().strftime('%Y-%m-%d')
 
         try:
-            response = requests.post(
+            response = _session.post(
                 f"{self.BASE_URL}/invoice/reverse",
                 headers=headers,
                 json=payload,
                 timeout=15
             )
-
-            if response.status_code == 200:
-                return response.json()
-            elif response.status_code == 401:
-                return {'error': 'Invalid SmartBill credentials'}
-            elif response.status_code == 403:
-                return {'error': 'Access forbidden - check your SmartBill plan or permissions'}
-            elif response.status_code == 404:
-                return {'error': f'Invoice not found: {series}-{number}'}
-            else:
-                return {'error': f'SmartBill API error: {response.status_code} - {response.text[:200]}'}
-
+            return self._handle_response(response, self.INVOICE_ERRORS,
+                                         series=series, number=number)
         except requests.exceptions.RequestException as e:
             return {'error': f'Connection error: {str(e)}'}
@@ -0,0 +1,44 @@
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from http_session import create_session
+
+
+class _CookieHandler(BaseHTTPRequestHandler):
+    received = []
+
+    def do_GET(self):
+        self.received.append(self.headers.get('Cookie'))
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'JSESSIONID=tenant-a; Path=/')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class SharedSessionCookieTest(unittest.TestCase):
+    def setUp(self):
+        _CookieHandler.received = []
+        self.server = HTTPServer(('127.0.0.1', 0), _CookieHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_cookie_from_one_response_is_not_sent_on_the_next_request(self):
+        session = create_session()
+        session.get(self.url, timeout=5)
+        session.get(self.url, timeout=5)
+
+        self.assertEqual(_CookieHandler.received, [None, None])
+        self.assertEqual(len(session.cookies), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+
+from postal_code import parse_postal_code_page
+
+
+class ParsePostalCodePageTest(unittest.TestCase):
+    def test_result_row_of_the_first_table(self):
+        page = (b'<html><body><table>'
+                b'<tr><th>Code</th><th>Street</th><th>City</th><th>County</th></tr>'
+                b'<tr><td>010011</td><td>Calea Victoriei</td>'
+                b'<td>Bucure&#537;ti</td><td><b>Sector 1</b></td></tr>'
+                b'</table></body></html>')
+
+        self.assertEqual(parse_postal_code_page(page), {
+            'city': 'București',
+            'county': 'Sector 1'
+        })
+
+    def test_row_from_a_later_table_is_not_used(self):
+        page = (b'<html><body><table>'
+                b'<tr><th>Code</th><th>Street</th><th>City</th><th>County</th></tr>'
+                b'</table><table>'
+                b'<tr><td>a</td><td>b</td><td>WRONGCITY</td><td>WRONGCOUNTY</td></tr>'
+                b'</table></body></html>')
+
+        self.assertIsNone(parse_postal_code_page(page))
+
+
+if __name__ == '__main__':
+    unittest.main()
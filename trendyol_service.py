@@ -1,13 +1,43 @@
+import logging
 import requests
 import base64
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from io import BytesIO
+from cache import TTLCache
+from http_session import create_session, decode_json
+
+logger = logging.getLogger(__name__)
+
+_BUCHAREST = ZoneInfo('Europe/Bucharest')
+
+
+# Shared by every service instance so connections to the Trendyol API are
+# kept alive across requests. Credentials are passed per call in headers.
+_session = create_session()
+
+# Every order matching a filter, with an index of the SKUs and barcodes in
+# them, kept briefly so the pages of one SKU-filtered listing share a single
+# fetch of the full history. Keyed by supplier, API key and filters, and
+# bounded by the number of orders held. The cache is per process: an
+# invoice upload clears the supplier's entries only in the worker that did
+# it, so other workers may list orders without their new invoiceLink for up
+# to a minute. Callers that pick orders by invoiceLink pass fresh=True.
+_sku_orders_cache = TTLCache(ttl=60,
+                             maxsize=16,
+                             weigh=lambda entry: len(entry[0]),
+                             maxweight=20000)
 
 
 class TrendyolService:
     BASE_URL = "https://api.trendyol.com/sapigw"
     INTEGRATION_BASE_URL = "https://apigw.trendyol.com/integration"
+    LABEL_CHUNK_SIZE = 64 * 1024
+    # Orders are fetched this many per page (the API maximum) when every
+    # page is needed for client-side filtering, PAGE_WORKERS pages at once
+    ORDERS_FETCH_SIZE = 200
+    PAGE_WORKERS = 8
 
     def __init__(self, api_key, api_secret, supplier_id):
         self.api_key = api_key
@@ -35,18 +65,21 @@ class TrendyolService:
                    start_date='',
                    end_date='',
                    order_number='',
-                   sku=''):
+                   sku='',
+                   fresh=False):
+        # fresh=True refetches a SKU-filtered history instead of using the
+        # cached one (and caches the result for the following pages)
         # Use the recommended integration endpoint
         url = f"{self.INTEGRATION_BASE_URL}/order/sellers/{self.supplier_id}/orders"
 
-        print(
-            f"[DEBUG] get_orders called with: page={page}, size={size}, status='{status}', start_date='{start_date}', end_date='{end_date}', order_number='{order_number}', sku='{sku}'"
-        )
+        logger.debug(
+            "get_orders called with: page=%s, size=%s, status='%s', start_date='%s', end_date='%s', order_number='%s', sku='%s'",
+            page, size, status, start_date, end_date, order_number, sku)
 
         # Handle multiple statuses (comma-separated)
         if status and ',' in status:
             statuses = [s.strip() for s in status.split(',')]
-            print(f"[DEBUG] Multiple statuses detected: {statuses}")
+            logger.debug("Multiple statuses detected: %s", statuses)
             return self._get_orders_multiple_statuses(
                 statuses, page, size, start_date, end_date, order_number, sku
             )
@@ -64,87 +97,62 @@ class TrendyolService:
         if start_date:
             formatted_start = self._format_date(start_date)
             params['startDate'] = formatted_start
-            print(f"[DEBUG] Start date: {start_date} -> {formatted_start}")
+            logger.debug("Start date: %s -> %s", start_date, formatted_start)
         else:
-            print(f"[DEBUG] No start_date provided")
+            logger.debug("No start_date provided")
 
         if end_date:
             formatted_end = self._format_date(end_date)
             params['endDate'] = formatted_end
-            print(f"[DEBUG] End date: {end_date} -> {formatted_end}")
+            logger.debug("End date: %s -> %s", end_date, formatted_end)
         else:
-            print(f"[DEBUG] No end_date provided")
+            logger.debug("No end_date provided")
 
         if order_number:
             params['orderNumber'] = order_number
 
-        print(f"[DEBUG] Trendyol API URL: {url}")
-        print(f"[DEBUG] Trendyol API params: {params}")
+        logger.debug("Trendyol API URL: %s", url)
+        logger.debug("Trendyol API params: %s", params)
 
         # If SKU filter is provided, fetch ALL pages first, then filter client-side
         if sku:
-            print(f"[DEBUG] SKU filter detected: '{sku}' - fetching all pages for client-side filtering")
-            all_orders = []
-            fetch_page = 0
-            fetch_size = 200  # Use max page size for efficiency
-            
-            while True:
-                fetch_params = params.copy()
-                fetch_params['page'] = fetch_page
-                fetch_params['size'] = fetch_size
-                
-                try:
-                    response = requests.get(url, headers=self.headers, params=fetch_params)
-                    response.raise_for_status()
-                    result = response.json()
-                    
-                    content = result.get('content', [])
-                    all_orders.extend(content)
-                    
-                    print(f"[DEBUG] Fetched page {fetch_page}: {len(content)} orders")
-                    
-                    # Stop if we got fewer results than requested (last page)
-                    if len(content) < fetch_size:
-                        break
-                    
-                    fetch_page += 1
-                except requests.exceptions.HTTPError as e:
+            cache_key = (self.supplier_id, self.api_key, status, start_date,
+                         end_date, order_number)
+            cached = None if fresh else _sku_orders_cache.get(cache_key)
+            if cached is not None:
+                all_orders, sku_index = cached
+                logger.debug(
+                    "SKU filter detected: '%s' - using %s cached orders",
+                    sku, len(all_orders))
+            else:
+                logger.debug(
+                    "SKU filter detected: '%s' - fetching all pages for client-side filtering",
+                    sku)
+                with ThreadPoolExecutor(max_workers=self.PAGE_WORKERS) as executor:
+                    all_orders, _, failed_page, e = self._fetch_all_pages(
+                        executor, url, params)
+
+                if e is not None:
                     # If first page fails, propagate error to caller
-                    if fetch_page == 0:
-                        status_code = e.response.status_code if e.response else 500
-                        return {
-                            'error': f'Failed to fetch orders: {str(e)}',
-                            'status': status_code
-                        }
+                    if failed_page == 0:
+                        return self._error_result(e, 'Failed to fetch orders')
                     # Subsequent page failures: log and continue with partial results
-                    print(f"[DEBUG] Error fetching page {fetch_page}: {e} - continuing with partial results")
-                    break
-                except requests.exceptions.RequestException as e:
-                    # If first page fails, propagate error to caller
-                    if fetch_page == 0:
-                        return {
-                            'error': f'Failed to fetch orders: {str(e)}',
-                            'status': 500
-                        }
-                    # Subsequent page failures: log and continue with partial results
-                    print(f"[DEBUG] Error fetching page {fetch_page}: {e} - continuing with partial results")
-                    break
-            
-            print(f"[DEBUG] Total orders fetched: {len(all_orders)}")
+                    logger.warning(
+                        "Error fetching page %s: %s - continuing with partial results",
+                        failed_page, e)
+                
+                logger.debug("Total orders fetched: %s", len(all_orders))
+                sku_index = self._build_sku_index(all_orders)
+                # Partial results are served but not cached
+                if e is None:
+                    _sku_orders_cache.set(cache_key, (all_orders, sku_index))
             
             # Apply SKU filter to all orders
-            filtered_orders = []
-            for order in all_orders:
-                lines = order.get('lines', [])
-                for line in lines:
-                    merchant_sku = line.get('merchantSku', '')
-                    barcode = line.get('barcode', '')
-                    
-                    if sku.lower() in merchant_sku.lower() or sku.lower() in barcode.lower():
-                        filtered_orders.append(order)
-                        break
+            filtered_orders = self._filter_by_sku(all_orders, sku_index, sku)
             
-            print(f"[DEBUG] SKU filter: {len(all_orders)} orders -> {len(filtered_orders)} orders")
+            logger.debug(
+                "SKU filter: %s orders -> %s orders",
+                len(all_orders), len(filtered_orders))
             
             # Apply pagination to filtered results
             start_idx = page * size
@@ -164,129 +172,116 @@ class TrendyolService:
 
         # No SKU filter - use standard single-page fetch
         try:
-            response = requests.get(url, headers=self.headers, params=params)
+            response = _session.get(url, headers=self.headers, params=params)
             response.raise_for_status()
-            result = response.json()
+            result = decode_json(response)
 
             # Debug: Show response details
             content_count = len(result.get('content', []))
             total_elements = result.get('totalElements', 'N/A')
-            print(f"[DEBUG] API Response: Requested size={size}, Received={content_count} orders, Total available={total_elements}")
+            logger.debug(
+                "API Response: Requested size=%s, Received=%s orders, Total available=%s",
+                size, content_count, total_elements)
             
             # Debug: Show first order date if available
             if result.get('content') and len(result['content']) > 0:
                 first_order = result['content'][0]
-                print(
-                    f"[DEBUG] First order date: {first_order.get('orderDate')} (Order: {first_order.get('orderNumber')})"
-                )
+                logger.debug(
+                    "First order date: %s (Order: %s)",
+                    first_order.get('orderDate'), first_order.get('orderNumber'))
 
             return result
-        except requests.exceptions.HTTPError as e:
-            status_code = e.response.status_code if e.response else 500
-            return {
-                'error': f'Failed to fetch orders: {str(e)}',
-                'status': status_code
-            }
         except requests.exceptions.RequestException as e:
-            return {
-                'error': f'Failed to fetch orders: {str(e)}',
-                'status': 500
-            }
+            return self._error_result(e, 'Failed to fetch orders')
 
     def _get_orders_multiple_statuses(self, statuses, page, size, start_date, end_date, order_number, sku=''):
         """Fetch orders for multiple statuses and combine results."""
+        # First occurrence of each order id, and those of them that pass the
+        # SKU filter, both in the order they were seen
+        orders_by_id = {}
         all_orders = []
-        seen_order_ids = set()
+        # Bound once: the merge loop below runs for every fetched order
+        first_seen = orders_by_id.setdefault
+        keep = all_orders.append
+        sku_lower = sku.lower()
+        url = f"{self.INTEGRATION_BASE_URL}/order/sellers/{self.supplier_id}/orders"
         
-        # Fetch ALL available orders for each status to get accurate totals
-        # API max is 200 per request, so we'll fetch multiple pages
-        fetch_size = 200
+        # The same filters apply to every status, so dates are formatted once
+        base_params: dict = {
+            'orderByField': 'CreatedDate',
+            'orderByDirection': 'ASC'
+        }
         
-        for status in statuses:
-            url = f"{self.INTEGRATION_BASE_URL}/order/sellers/{self.supplier_id}/orders"
-            
-            # Fetch all pages for this status until no more data
-            fetch_page = 0
-            while True:
-                params: dict = {
-                    'page': fetch_page,
-                    'size': fetch_size,
-                    'orderByField': 'CreatedDate',
-                    'orderByDirection': 'ASC',
-                    'status': status
-                }
-                
-                if start_date:
-                    params['startDate'] = self._format_date(start_date)
-                
-                if end_date:
-                    params['endDate'] = self._format_date(end_date)
-                
-                if order_number:
-                    params['orderNumber'] = order_number
-                
-                try:
-                    response = requests.get(url, headers=self.headers, params=params)
-                    response.raise_for_status()
-                    result = response.json()
-                    
-                    content = result.get('content', [])
-                    if content:
-                        for order in content:
-                            # Avoid duplicates (same order might have multiple statuses)
-                            order_id = order.get('id') or order.get('orderNumber')
-                            if order_id not in seen_order_ids:
-                                all_orders.append(order)
-                                seen_order_ids.add(order_id)
-                    
-                    # If we got fewer results than requested, no more pages for this status
-                    if len(content) < fetch_size:
-                        break
-                    
-                    # Move to next page
-                    fetch_page += 1
-                        
-                except requests.exceptions.RequestException as e:
-                    print(f"[DEBUG] Error fetching orders for status '{status}', page {fetch_page}: {e}")
-                    break
+        if start_date:
+            base_params['startDate'] = self._format_date(start_date)
+        
+        if end_date:
+            base_params['endDate'] = self._format_date(end_date)
+        
+        if order_number:
+            base_params['orderNumber'] = order_number
+        
+        # Without a SKU filter every order counts, and each status comes back
+        # ascending, so the first (page+1)*size orders of the merged result
+        # are among the first (page+1)*size of each status. Only that many
+        # are fetched; the rest are counted from the totals Trendyol reports.
+        # A SKU filter needs every order looked at; an order number filter
+        # already leaves Trendyol only the matching orders to return.
+        limit = None if sku or order_number else (page + 1) * size
+        unfetched = 0
+        
+        # The statuses are fetched concurrently, and so are the pages of each
+        # status after the first; results are merged in status order.
+        with ThreadPoolExecutor(max_workers=len(statuses)) as status_executor, \
+                ThreadPoolExecutor(max_workers=self.PAGE_WORKERS) as page_executor:
+            futures = [
+                status_executor.submit(self._fetch_all_pages, page_executor,
+                                       url, dict(base_params, status=status),
+                                       limit)
+                for status in statuses
+            ]
+            for status, future in zip(statuses, futures):
+                content, total, failed_page, e = future.result()
+                if e is not None:
+                    logger.warning(
+                        "Error fetching orders for status '%s', page %s: %s",
+                        status, failed_page, e)
+                elif limit is not None and total:
+                    unfetched += max(total - len(content), 0)
+                for order in content:
+                    # Avoid duplicates (same order might have multiple statuses)
+                    # and apply the client-side SKU filter (Trendyol API
+                    # doesn't support one) in the same pass
+                    first = first_seen(
+                        order.get('id') or order.get('orderNumber'), order)
+                    if first is order and (
+                            not sku or self._order_has_sku(order, sku_lower)):
+                        keep(order)
         
-        # Client-side SKU filtering (Trendyol API doesn't support SKU filter)
         if sku:
-            print(f"[DEBUG] Applying client-side SKU filter to multi-status results: '{sku}'")
-            original_count = len(all_orders)
-            filtered_orders = []
-            
-            for order in all_orders:
-                # Check if any line item in the order has matching SKU
-                lines = order.get('lines', [])
-                for line in lines:
-                    # Match against merchantSku or barcode
-                    merchant_sku = line.get('merchantSku', '')
-                    barcode = line.get('barcode', '')
-                    
-                    if sku.lower() in merchant_sku.lower() or sku.lower() in barcode.lower():
-                        filtered_orders.append(order)
-                        break  # Found match, no need to check other lines
-            
-            all_orders = filtered_orders
-            print(f"[DEBUG] SKU filter (multi-status): {original_count} orders -> {len(all_orders)} orders")
+            logger.debug(
+                "SKU filter (multi-status) '%s': %s orders -> %s orders",
+                sku, len(orders_by_id), len(all_orders))
         
-        # Sort combined results by CreatedDate (oldest first / ascending)
-        all_orders.sort(
-            key=lambda x: x.get('orderDate', 0), 
-            reverse=False
-        )
+        # Sort combined results by CreatedDate (oldest first / ascending).
+        # Each status arrives already ascending, so this merges S sorted runs
+        # rather than doing a full sort; a missing or null date sorts first.
+        all_orders.sort(key=lambda x: x.get('orderDate') or 0)
         
         # Apply pagination to combined results
         start_idx = page * size
         end_idx = start_idx + size
         paginated_orders = all_orders[start_idx:end_idx]
         
-        total_unique = len(all_orders)
+        # Orders left unfetched are counted as unique; duplicates among
+        # them can't be seen without fetching them
+        total_unique = len(all_orders) + unfetched
         total_pages = (total_unique + size - 1) // size if size > 0 else 0
         
-        print(f"[DEBUG] Combined {total_unique} unique orders from {len(statuses)} statuses")
-        print(f"[DEBUG] Returning page {page}/{total_pages} ({start_idx}-{end_idx}) with {len(paginated_orders)} orders")
+        logger.debug("Combined %s unique orders from %s statuses", total_unique, len(statuses))
+        logger.debug(
+            "Returning page %s/%s (%s-%s) with %s orders",
+            page, total_pages, start_idx, end_idx, len(paginated_orders))
         
         return {
             'content': paginated_orders,
@@ -296,28 +291,181 @@ class TrendyolService:
             'totalPages': total_pages
         }
 
+    @staticmethod
+    def _error_result(e, message, use_body_message=False):
+        """
+        Error dict for a failed request, with the HTTP status of the error
+        response when there is one and 500 otherwise. With use_body_message,
+        the 'message' of a JSON error body replaces the generic message.
+        """
+        result = {'error': f'{message}: {str(e)}', 'status': 500}
+        response = e.response
+        if response is None:
+            return result
+        result['status'] = response.status_code
+        if use_body_message:
+            try:
+                error_data = decode_json(response)
+            except ValueError:
+                logger.debug("Error response text: %s", response.text)
+            else:
+                logger.debug("Error response JSON: %s", error_data)
+                if isinstance(error_data, dict):
+                    result['error'] = error_data.get('message', result['error'])
+        return result
+
+    @staticmethod
+    def _build_sku_index(orders):
+        """Map each lowercased merchantSku/barcode to the positions of the orders containing it."""
+        index = {}
+        for i, order in enumerate(orders):
+            for line in order.get('lines', []):
+                for value in (line.get('merchantSku') or '', line.get('barcode') or ''):
+                    positions = index.setdefault(value.lower(), [])
+                    if not positions or positions[-1] != i:
+                        positions.append(i)
+        return index
+
+    @staticmethod
+    def _order_has_sku(order, sku_lower):
+        """Whether a line's merchantSku or barcode contains the lowercased sku."""
+        for line in order.get('lines', []):
+            if (sku_lower in (line.get('merchantSku') or '').lower()
+                    or sku_lower in (line.get('barcode') or '').lower()):
+                return True
+        return False
+
+    @staticmethod
+    def _filter_by_sku(orders, sku_index, sku):
+        """
+        The orders, in their original order, with a line whose merchantSku or
+        barcode contains sku (case-insensitive). Each distinct SKU/barcode is
+        tested once, however many lines share it.
+        """
+        sku_lower = sku.lower()
+        matches = set()
+        for value, positions in sku_index.items():
+            if sku_lower in value:
+                matches.update(positions)
+        return [orders[i] for i in sorted(matches)]
+
+    def _invalidate_orders_cache(self):
+        supplier_id = self.supplier_id
+        _sku_orders_cache.delete_where(lambda key: key[0] == supplier_id)
+
+    def _fetch_orders_page(self, url, params, page):
+        fetch_params = dict(params, page=page, size=self.ORDERS_FETCH_SIZE)
+        response = _session.get(url, headers=self.headers, params=fetch_params)
+        response.raise_for_status()
+        return decode_json(response)
+
+    def _fetch_all_pages(self, executor, url, params, limit=None):
+        """
+        Fetch every page of orders for params, stopping at the first short
+        or failed page, or once at least limit orders are in. The first page
+        tells how many pages there are; the rest are fetched concurrently on
+        executor and kept in page order.
+
+        Returns:
+            (orders, total, failed_page, error): the orders fetched before
+            any failure, the totalElements reported with the first page (or
+            None), and the page number and RequestException of the failure,
+            or (orders, total, None, None)
+        """
+        try:
+            result = self._fetch_orders_page(url, params, 0)
+        except requests.exceptions.RequestException as e:
+            return [], None, 0, e
+
+        orders = list(result.get('content', []))
+        total = result.get('totalElements')
+        logger.debug("Fetched page 0: %s orders", len(orders))
+        if len(orders) < self.ORDERS_FETCH_SIZE or (
+                limit is not None and len(orders) >= limit):
+            return orders, total, None, None
+
+        total_pages = result.get('totalPages')
+        if total_pages is None:
+            # No page count in the response: walk the pages one by one
+            page = 1
+            while True:
+                try:
+                    content = self._fetch_orders_page(url, params,
+                                                      page).get('content', [])
+                except requests.exceptions.RequestException as e:
+                    return orders, total, page, e
+                orders.extend(content)
+                if len(content) < self.ORDERS_FETCH_SIZE or (
+                        limit is not None and len(orders) >= limit):
+                    return orders, total, None, None
+                page += 1
+
+        if limit is not None:
+            total_pages = min(total_pages,
+                              -(-limit // self.ORDERS_FETCH_SIZE))
+
+        futures = [
+            executor.submit(self._fetch_orders_page, url, params, page)
+            for page in range(1, total_pages)
+        ]
+        try:
+            for page, future in enumerate(futures, start=1):
+                try:
+                    content = future.result().get('content', [])
+                except requests.exceptions.RequestException as e:
+                    return orders, total, page, e
+                orders.extend(content)
+                logger.debug("Fetched page %s: %s orders", page, len(content))
+                if len(content) < self.ORDERS_FETCH_SIZE:
+                    break
+        finally:
+            for future in futures:
+                future.cancel()
+        return orders, total, None, None
+
     def get_shipping_label(self, package_id):
         url = f"{self.BASE_URL}/suppliers/{self.supplier_id}/shipment-packages/{package_id}/cargo-label"
-        print(f"[DEBUG] Fetching label from URL: {url}")
+        logger.debug("Fetching label from URL: %s", url)
 
+        response = None
         try:
-            response = requests.get(url, headers=self.headers)
-            print(
-                f"[DEBUG] Response status: {response.status_code}, Content-Type: {response.headers.get('Content-Type')}"
-            )
+            response = _session.get(url, headers=self.headers, stream=True)
+            logger.debug(
+                "Response status: %s, Content-Type: %s",
+                response.status_code, response.headers.get('Content-Type'))
             response.raise_for_status()
 
-            if response.status_code == 204 or not response.content:
+            chunks = response.iter_content(chunk_size=self.LABEL_CHUNK_SIZE)
+            first_chunk = next(chunks, b'')
+            if response.status_code == 204 or not first_chunk:
+                response.close()
                 return (None, 404)
 
-            return (BytesIO(response.content), response.status_code)
+            return (self._stream_label(response, first_chunk, chunks),
+                    response.status_code)
         except requests.exceptions.HTTPError as e:
-            status_code = e.response.status_code if e.response else 500
+            status_code = 500
+            if e.response is not None:
+                status_code = e.response.status_code
+                e.response.close()
             return (None, status_code)
         except requests.exceptions.RequestException as e:
-            print(f"Error fetching shipping label: {e}")
+            # Also raised while reading the first chunk of a streamed
+            # response, which must then be released here
+            if response is not None:
+                response.close()
+            logger.warning("Error fetching shipping label: %s", e)
             return (None, 500)
 
+    @staticmethod
+    def _stream_label(response, first_chunk, chunks):
+        """Yield the label PDF as it arrives, releasing the connection at the end."""
+        try:
+            yield first_chunk
+            yield from chunks
+        finally:
+            response.close()
+
     def get_shipment_packages(self,
                               page=0,
                               size=50,
@@ -342,20 +490,11 @@ class TrendyolService:
             params['orderNumber'] = order_number
 
         try:
-            response = requests.get(url, headers=self.headers, params=params)
+            response = _session.get(url, headers=self.headers, params=params)
             response.raise_for_status()
-            return response.json()
-        except requests.exceptions.HTTPError as e:
-            status_code = e.response.status_code if e.response else 500
-            return {
-                'error': f'Failed to fetch shipment packages: {str(e)}',
-                'status': status_code
-            }
+            return decode_json(response)
         except requests.exceptions.RequestException as e:
-            return {
-                'error': f'Failed to fetch shipment packages: {str(e)}',
-                'status': 500
-            }
+            return self._error_result(e, 'Failed to fetch shipment packages')
 
     def send_invoice_link(self,
                           shipment_package_id,
@@ -375,33 +514,19 @@ class TrendyolService:
         if invoice_datetime:
             payload['invoiceDateTime'] = invoice_datetime
 
-        print(f"[DEBUG] Sending invoice link to URL: {url}")
-        print(f"[DEBUG] Payload: {payload}")
-        print(f"[DEBUG] Headers: {self.headers}")
+        logger.debug("Sending invoice link to URL: %s", url)
+        logger.debug("Payload: %s", payload)
 
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
-            print(f"[DEBUG] Response status: {response.status_code}")
-            print(f"[DEBUG] Response body: {response.text}")
+            response = _session.post(url, headers=self.headers, json=payload)
+            logger.debug("Response status: %s", response.status_code)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Response body: %s", response.text)
             response.raise_for_status()
+            self._invalidate_orders_cache()
             return {'success': True, 'status': response.status_code}
-        except requests.exceptions.HTTPError as e:
-            status_code = e.response.status_code if e.response else 500
-            error_msg = f'Failed to send invoice link: {str(e)}'
-            if e.response:
-                try:
-                    error_data = e.response.json()
-                    error_msg = error_data.get('message', error_msg)
-                    print(f"[DEBUG] Error response JSON: {error_data}")
-                except:
-                    print(f"[DEBUG] Error response text: {e.response.text}")
-                    pass
-            return {'error': error_msg, 'status': status_code}
         except requests.exceptions.RequestException as e:
-            return {
-                'error': f'Failed to send invoice link: {str(e)}',
-                'status': 500
-            }
+            return self._error_result(e, 'Failed to send invoice link', use_body_message=True)
 
     def upload_invoice_file(self,
                             shipment_package_id,
@@ -411,14 +536,14 @@ class TrendyolService:
                             invoice_datetime=None):
         url = f"{self.INTEGRATION_BASE_URL}/sellers/{self.supplier_id}/seller-invoice-file"
 
-        auth_str = f"{self.api_key}:{self.api_secret}"
-        auth_header = base64.b64encode(auth_str.encode()).decode()
-
+        # No Content-Type: requests sets the multipart boundary itself
         headers = {
-            'Authorization': f'Basic {auth_header}',
+            'Authorization': self.headers.get('Authorization', ''),
             'Accept': 'application/json'
         }
 
+        # pdf_content may be bytes or an open file object; requests reads
+        # file objects itself when encoding the multipart body
         files = {
             'file': (filename, pdf_content, 'application/pdf')
         }
@@ -433,32 +558,19 @@ class TrendyolService:
         if invoice_datetime:
             data['invoiceDateTime'] = str(invoice_datetime)
 
-        print(f"[DEBUG] Uploading invoice file to URL: {url}")
-        print(f"[DEBUG] shipmentPackageId: {shipment_package_id}, filename: {filename}")
+        logger.debug("Uploading invoice file to URL: %s", url)
+        logger.debug("shipmentPackageId: %s, filename: %s", shipment_package_id, filename)
 
         try:
-            response = requests.post(url, headers=headers, files=files, data=data, timeout=30)
-            print(f"[DEBUG] Upload response status: {response.status_code}")
-            print(f"[DEBUG] Upload response body: {response.text}")
+            response = _session.post(url, headers=headers, files=files, data=data, timeout=30)
+            logger.debug("Upload response status: %s", response.status_code)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Upload response body: %s", response.text)
             response.raise_for_status()
+            self._invalidate_orders_cache()
             return {'success': True, 'status': response.status_code}
-        except requests.exceptions.HTTPError as e:
-            status_code = e.response.status_code if e.response else 500
-            error_msg = f'Failed to upload invoice file: {str(e)}'
-            if e.response:
-                try:
-                    error_data = e.response.json()
-                    error_msg = error_data.get('message', error_msg)
-                    print(f"[DEBUG] Upload error response JSON: {error_data}")
-                except:
-                    print(f"[DEBUG] Upload error response text: {e.response.text}")
-                    pass
-            return {'error': error_msg, 'status': status_code}
         except requests.exceptions.RequestException as e:
-            return {
-                'error': f'Failed to upload invoice file: {str(e)}',
-                'status': 500
-            }
+            return self._error_result(e, 'Failed to upload invoice file', use_body_message=True)
 
     def get_products(self, page=0, size=50, barcode='', approved=None):
         url = f"{self.BASE_URL}/suppliers/{self.supplier_id}/products"
@@ -472,22 +584,15 @@ class TrendyolService:
             params['approved'] = approved
 
         try:
-            response = requests.get(url, headers=self.headers, params=params)
+            response = _session.get(url, headers=self.headers, params=params)
             response.raise_for_status()
-            return response.json()
-        except requests.exceptions.HTTPError as e:
-            status_code = e.response.status_code if e.response else 500
-            return {
-                'error': f'Failed to fetch products: {str(e)}',
-                'status': status_code
-            }
+            return decode_json(response)
         except requests.exceptions.RequestException as e:
-            return {
-                'error': f'Failed to fetch products: {str(e)}',
-                'status': 500
-            }
+            return self._error_result(e, 'Failed to fetch products')
 
-    def _format_date(self, date_str):
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _format_date(date_str):
         try:
             # Parse date string and treat as Romanian timezone (Europe/Bucharest)
             # Expected format: YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS
@@ -495,9 +600,9 @@ class TrendyolService:
 
             # If no timezone info, treat as Romanian time
             if dt.tzinfo is None:
-                dt = dt.replace(tzinfo=ZoneInfo('Europe/Bucharest'))
+                dt = dt.replace(tzinfo=_BUCHAREST)
 
             # Convert to epoch milliseconds
             return int(dt.timestamp() * 1000)
-        except:
+        except ValueError:
             return date_str
@@ -1,39 +1,307 @@
+import atexit
+import base64
+import hashlib
+import queue
 import sqlite3
 import os
-from cryptography.fernet import Fernet
+import threading
+import time
+from contextlib import contextmanager
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+from cache import TTLCache
+
+try:
+    from argon2 import PasswordHasher
+    from argon2.exceptions import InvalidHashError, VerificationError
+except ImportError:  # new passwords are hashed with werkzeug's pbkdf2 instead
+    PasswordHasher = None
+
+try:
+    from gevent import get_hub, monkey
+except ImportError:  # only the gevent workers in gunicorn.conf.py need it
+    monkey = None
+
+# Query texts are fixed, so each is parsed once per pooled connection and
+# then served from sqlite3's statement cache
+SQL_INSERT = '''
+    INSERT INTO users (username, password_hash, trendyol_api_key, 
+                     trendyol_api_secret, trendyol_supplier_id,
+                     smartbill_api_token, smartbill_email, 
+                     smartbill_company_cif, smartbill_gestiune, role)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+SQL_AUTH = '''
+    SELECT id, username, password_hash, trendyol_api_key, trendyol_api_secret, 
+           trendyol_supplier_id, smartbill_api_token, smartbill_email,
+           smartbill_company_cif, smartbill_gestiune, role
+    FROM users 
+    WHERE username = ?
+'''
+SQL_GET_BY_ID = '''
+    SELECT id, username, trendyol_api_key, trendyol_api_secret, 
+           trendyol_supplier_id, smartbill_api_token, smartbill_email,
+           smartbill_company_cif, smartbill_gestiune, role
+    FROM users 
+    WHERE id = ?
+'''
+SQL_IDENTITY = 'SELECT id, username, role FROM users WHERE id = ?'
+SQL_CREDENTIALS = '''
+    SELECT trendyol_api_key, trendyol_api_secret, trendyol_supplier_id,
+           smartbill_api_token, smartbill_email, smartbill_company_cif,
+           smartbill_gestiune
+    FROM users
+    WHERE id = ?
+'''
+SQL_ALL_CREDENTIALS = '''
+    SELECT id, trendyol_api_key, trendyol_api_secret, trendyol_supplier_id,
+           smartbill_api_token, smartbill_email, smartbill_company_cif,
+           smartbill_gestiune
+    FROM users
+'''
+SQL_SET_CREDENTIALS = '''
+    UPDATE users SET
+        trendyol_api_key = ?, trendyol_api_secret = ?, trendyol_supplier_id = ?,
+        smartbill_api_token = ?, smartbill_email = ?, smartbill_company_cif = ?,
+        smartbill_gestiune = ?
+    WHERE id = ?
+'''
+SQL_ALL = '''
+    SELECT id, username, trendyol_api_key, trendyol_api_secret, 
+           trendyol_supplier_id, smartbill_api_token, smartbill_email,
+           smartbill_company_cif, smartbill_gestiune, role
+    FROM users
+'''
+# A NULL parameter leaves its column unchanged
+SQL_UPDATE = '''
+    UPDATE users SET
+        username = COALESCE(?, username),
+        password_hash = COALESCE(?, password_hash),
+        trendyol_api_key = COALESCE(?, trendyol_api_key),
+        trendyol_api_secret = COALESCE(?, trendyol_api_secret),
+        trendyol_supplier_id = COALESCE(?, trendyol_supplier_id),
+        smartbill_api_token = COALESCE(?, smartbill_api_token),
+        smartbill_email = COALESCE(?, smartbill_email),
+        smartbill_company_cif = COALESCE(?, smartbill_company_cif),
+        smartbill_gestiune = COALESCE(?, smartbill_gestiune),
+        role = COALESCE(?, role)
+    WHERE id = ?
+'''
+SQL_DELETE = 'DELETE FROM users WHERE id = ?'
+SQL_SET_PASSWORD_HASH = 'UPDATE users SET password_hash = ? WHERE id = ?'
+
+# Leading byte of credentials encrypted with AES-GCM. Fernet tokens written
+# before start with the text "gAAAAA", so the two can't be confused.
+AESGCM_VERSION = b'\x01'
+AESGCM_NONCE_SIZE = 12
+
+# pbkdf2 (used when argon2-cffi is missing) is tuned to this server: as many
+# iterations as take PBKDF2_TARGET_SECONDS, but never fewer than OWASP's
+# minimum for pbkdf2-sha256
+PBKDF2_TARGET_SECONDS = 0.25
+PBKDF2_MIN_ITERATIONS = 600_000
+
+
+def _calibrate_pbkdf2_iterations():
+    sample = 100_000
+    start = time.perf_counter()
+    hashlib.pbkdf2_hmac('sha256', b'calibration', os.urandom(16), sample)
+    elapsed = time.perf_counter() - start
+    return max(PBKDF2_MIN_ITERATIONS, int(sample * PBKDF2_TARGET_SECONDS / elapsed))
+
+
+def _run_hash(func, *args, **kwargs):
+    """
+    Run a password hash or check without stalling other requests. In a
+    gevent worker every request shares one OS thread, so the work goes to
+    gevent's pool of real threads; argon2 and hashlib release the GIL, so
+    hashes also run in parallel there. Elsewhere each request already has
+    its own thread and the call runs inline.
+    """
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
+
+def _credential(index):
+    """A User property for one credential, decrypted on first use."""
+    def get(self):
+        credentials = self._credentials
+        if credentials is None:
+            credentials = self._credentials = self._load_credentials(self)
+        return credentials[index]
+    return property(get)
 
 class User(UserMixin):
-    def __init__(self, id, username, trendyol_api_key, trendyol_api_secret, 
-                 trendyol_supplier_id, smartbill_api_token, smartbill_email, 
-                 smartbill_company_cif, smartbill_gestiune=None, role='user'):
+    # Slots keep the attributes out of a per-instance dict. UserMixin has no
+    # __slots__, so instances can still take other attributes if needed.
+    __slots__ = ('id', 'username', 'role', '_encrypted', '_load_credentials',
+                 '_credentials')
+    
+    # Users are loaded on every request but most pages use no credentials,
+    # so the seven columns are kept encrypted (or, for users loaded by
+    # get_user_identity, not even read) and decrypted together the first
+    # time any of them is used
+    trendyol_api_key = _credential(0)
+    trendyol_api_secret = _credential(1)
+    trendyol_supplier_id = _credential(2)
+    smartbill_api_token = _credential(3)
+    smartbill_email = _credential(4)
+    smartbill_company_cif = _credential(5)
+    smartbill_gestiune = _credential(6)
+    
+    def __init__(self, id, username, encrypted_credentials, load_credentials, role='user'):
         self.id = id
         self.username = username
-        self.trendyol_api_key = trendyol_api_key
-        self.trendyol_api_secret = trendyol_api_secret
-        self.trendyol_supplier_id = trendyol_supplier_id
-        self.smartbill_api_token = smartbill_api_token
-        self.smartbill_email = smartbill_email
-        self.smartbill_company_cif = smartbill_company_cif
-        self.smartbill_gestiune = smartbill_gestiune
         self.role = role
+        self._encrypted = encrypted_credentials
+        self._load_credentials = load_credentials
+        self._credentials = None
+    
+    @property
+    def has_trendyol_credentials(self):
+        return bool(self.trendyol_api_key and self.trendyol_api_secret
+                    and self.trendyol_supplier_id)
+    
+    @property
+    def has_smartbill_credentials(self):
+        return bool(self.smartbill_api_token and self.smartbill_email
+                    and self.smartbill_company_cif)
     
     def is_admin(self):
         return self.role == 'admin'
 
 class UserManager:
-    def __init__(self, db_path='users.db'):
+    # Connections are kept open between calls instead of reopening the
+    # database each time. When all are checked out an extra one is opened
+    # and closed again on release, rather than making the caller wait.
+    POOL_SIZE = 4
+    
+    # Databases whose schema this process has already checked, so further
+    # managers for the same file skip the CREATE IF NOT EXISTS round
+    _initialized_paths = set()
+    
+    def __init__(self, db_path='users.db', conn=None):
         self.db_path = db_path
+        # An existing connection (e.g. the one migrate_db.py runs its
+        # migration on) is used for every query and left open for the
+        # caller, who also commits its transaction
+        self._conn = conn
+        self._pool = queue.Queue(maxsize=self.POOL_SIZE)
+        self._write_lock = threading.Lock()
+        # Users loaded by id, which happens on every request. They hold
+        # decrypted credentials, so they are only ever cached in process
+        # memory. Changes made here invalidate the entry; other workers pick
+        # them up when the short TTL runs out.
+        self._user_cache = TTLCache(ttl=60)
         encryption_key = 'Yx6--EB097yXUu4wN5jR5NYq7CTaed5WIyzGj0XXq7w='
         if not encryption_key:
             raise ValueError("ENCRYPTION_KEY environment variable must be set")
         self.cipher = Fernet(encryption_key.encode())
-        self._init_db()
+        # New credentials use AES-GCM (one hardware-accelerated pass instead
+        # of Fernet's AES-CBC plus HMAC), keyed from the same secret so no
+        # new setting is needed. Fernet stays for decrypting older rows.
+        self._aead = AESGCM(HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None,
+            info=b'facturitrendy user credentials'
+        ).derive(base64.urlsafe_b64decode(encryption_key)))
+        # Argon2id in native code, costing ~50 ms and 46 MiB per hash. Older
+        # pbkdf2 hashes still verify and are replaced on the next login.
+        self._ph = None
+        self._pbkdf2_iterations = None
+        if PasswordHasher is not None:
+            self._ph = PasswordHasher(time_cost=2, memory_cost=47104, parallelism=1)
+        else:
+            self._pbkdf2_iterations = _calibrate_pbkdf2_iterations()
+        # Checked against when a username doesn't exist
+        self._dummy_hash = self._hash_password(os.urandom(16).hex())
+        if conn is not None or db_path not in self._initialized_paths:
+            self._init_db()
+            self._initialized_paths.add(db_path)
+        atexit.register(self.close)
+    
+    def connect(self):
+        """Open a new connection to the database with the per-connection settings."""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                               cached_statements=256)
+        # These settings are per connection, unlike journal_mode.
+        # foreign_keys makes order_invoices' ON DELETE CASCADE take effect.
+        conn.execute('PRAGMA foreign_keys=ON')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA mmap_size=268435456')
+        # ~20 MB page cache; pooled connections keep it warm between calls
+        conn.execute('PRAGMA cache_size=-20000')
+        return conn
+    
+    def close(self):
+        """Close the pooled connections."""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+    
+    def _open(self):
+        if self._conn is not None:
+            return self._conn
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self.connect()
+    
+    def _close(self, conn):
+        if conn is self._conn:
+            return
+        # Never hand the next caller a connection with a half-done transaction
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+    
+    def _commit(self, conn):
+        if conn is not self._conn:
+            conn.commit()
+    
+    @contextmanager
+    def _borrow(self, write=False):
+        """
+        Borrow a pooled connection for a block of queries. In WAL mode reads
+        run in parallel on their own connections; writes also take the write
+        lock, so they queue here instead of in SQLite's busy timeout.
+        """
+        conn = self._open()
+        try:
+            if write:
+                with self._write_lock:
+                    yield conn
+            else:
+                yield conn
+        finally:
+            self._close(conn)
     
     def _init_db(self):
-        conn = sqlite3.connect(self.db_path)
+        with self._borrow(write=True) as conn:
+            self._create_schema(conn)
+    
+    def _create_schema(self, conn):
         c = conn.cursor()
+        if conn is not self._conn:
+            # WAL is persistent in the database file, so setting it once here
+            # covers every connection. It can't be changed inside the
+            # caller's transaction on a connection passed in.
+            c.execute('PRAGMA journal_mode=WAL')
+        # sqlite3 runs DDL outside a transaction, so without this each
+        # statement would commit (and sync) separately. executescript isn't
+        # used as it would first commit a transaction the caller has open.
+        if not conn.in_transaction:
+            c.execute('BEGIN')
         c.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -61,210 +329,289 @@ class UserManager:
                 UNIQUE(user_id, order_id)
             )
         ''')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_user_invoices ON order_invoices(user_id, order_id)')
-        conn.commit()
-        conn.close()
+        # UNIQUE(user_id, order_id) already creates this index; the
+        # explicit copy only doubled the cost of every write
+        c.execute('DROP INDEX IF EXISTS idx_user_invoices')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_invoices_created ON order_invoices(created_at DESC)')
+        self._init_invoice_search(c)
+        self._commit(conn)
+    
+    def _init_invoice_search(self, c):
+        # Trigram full-text index over the searchable invoice columns, kept in
+        # sync with order_invoices by triggers. Trigrams match substrings, so
+        # MATCH gives the same results as LIKE '%term%' for terms of 3+ chars.
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'order_invoices_fts'")
+        if c.fetchone():
+            return
+        c.execute('''
+            CREATE VIRTUAL TABLE order_invoices_fts USING fts5(
+                order_id, invoice_series, invoice_number,
+                content='order_invoices', content_rowid='id',
+                tokenize='trigram'
+            )
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS order_invoices_fts_insert AFTER INSERT ON order_invoices BEGIN
+                INSERT INTO order_invoices_fts (rowid, order_id, invoice_series, invoice_number)
+                VALUES (new.id, new.order_id, new.invoice_series, new.invoice_number);
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS order_invoices_fts_delete AFTER DELETE ON order_invoices BEGIN
+                INSERT INTO order_invoices_fts (order_invoices_fts, rowid, order_id, invoice_series, invoice_number)
+                VALUES ('delete', old.id, old.order_id, old.invoice_series, old.invoice_number);
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS order_invoices_fts_update AFTER UPDATE ON order_invoices BEGIN
+                INSERT INTO order_invoices_fts (order_invoices_fts, rowid, order_id, invoice_series, invoice_number)
+                VALUES ('delete', old.id, old.order_id, old.invoice_series, old.invoice_number);
+                INSERT INTO order_invoices_fts (rowid, order_id, invoice_series, invoice_number)
+                VALUES (new.id, new.order_id, new.invoice_series, new.invoice_number);
+            END
+        ''')
+        # Index the invoices that existed before the search table
+        c.execute("INSERT INTO order_invoices_fts (order_invoices_fts) VALUES ('rebuild')")
     
     def _hash_password(self, password):
-        return generate_password_hash(password, method='pbkdf2:sha256', salt_length=16)
+        if self._ph is not None:
+            return _run_hash(self._ph.hash, password)
+        return _run_hash(
+            generate_password_hash, password,
+            method=f'pbkdf2:sha256:{self._pbkdf2_iterations}', salt_length=16)
+    
+    def _verify_password(self, password_hash, password):
+        """(matches, needs_rehash) for password against a stored hash."""
+        if password_hash.startswith('$argon2'):
+            if self._ph is None or not _run_hash(
+                    self._argon2_matches, password_hash, password):
+                return False, False
+            return True, self._ph.check_needs_rehash(password_hash)
+        if not _run_hash(check_password_hash, password_hash, password):
+            return False, False
+        return True, self._ph is not None
     
+    def _argon2_matches(self, password_hash, password):
+        # A bool rather than an exception, which gevent's pool would log
+        try:
+            return self._ph.verify(password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    
+    # Credentials are stored as bytes: the version byte, nonce, then the
+    # AES-GCM ciphertext and tag. SQLite keeps them as BLOBs whatever the
+    # column's declared type. Older rows hold a Fernet token, as TEXT or
+    # bytes, and are decrypted with Fernet.
     def _encrypt(self, value):
         if value is None:
             return None
-        return self.cipher.encrypt(value.encode()).decode()
+        nonce = os.urandom(AESGCM_NONCE_SIZE)
+        return AESGCM_VERSION + nonce + self._aead.encrypt(nonce, value.encode(), None)
     
-    def _decrypt(self, encrypted_value):
-        if encrypted_value is None:
-            return None
-        return self.cipher.decrypt(encrypted_value.encode()).decode()
+    def _decrypt_many(self, encrypted_values):
+        # The only decryption path: one pass over a row's credential
+        # columns, with the bound methods looked up once
+        aead_decrypt = self._aead.decrypt
+        fernet_decrypt = self.cipher.decrypt
+        start = AESGCM_NONCE_SIZE + 1
+        values = []
+        for value in encrypted_values:
+            if value is None:
+                values.append(None)
+            elif value[:1] == AESGCM_VERSION:
+                values.append(aead_decrypt(value[1:start], value[start:], None).decode())
+            else:
+                values.append(fernet_decrypt(value).decode())
+        return values
+    
+    def reencrypt_credentials(self):
+        """
+        Re-encrypt with AES-GCM the credentials still stored as Fernet
+        tokens, so reading them no longer needs Fernet's AES-CBC and HMAC.
+        Rows that cannot be decrypted with the current key are left as they
+        are and reported.
+        
+        Returns:
+            (updated, unreadable): the number of users updated, and the ids
+            of the users whose credentials could not be decrypted
+        """
+        updates = []
+        unreadable = []
+        with self._borrow(write=True) as conn:
+            for row in conn.execute(SQL_ALL_CREDENTIALS).fetchall():
+                if not any(value is not None and value[:1] != AESGCM_VERSION
+                           for value in row[1:]):
+                    continue
+                try:
+                    values = self._decrypt_many(row[1:])
+                except (InvalidToken, InvalidTag):
+                    unreadable.append(row[0])
+                    continue
+                updates.append(
+                    (*[self._encrypt(value) for value in values], row[0]))
+            conn.executemany(SQL_SET_CREDENTIALS, updates)
+            self._commit(conn)
+        self._user_cache.clear()
+        return len(updates), unreadable
+    
+    def _user_from_row(self, user_id, username, credentials, role):
+        """Build a User from the seven encrypted credential columns, in table order."""
+        return User(user_id, username, tuple(credentials), self._user_credentials,
+                    role=role or 'user')
+    
+    def _user_credentials(self, user):
+        """A User's decrypted credentials, read from the database if it was loaded without them."""
+        encrypted = user._encrypted
+        if encrypted is None:
+            with self._borrow() as conn:
+                encrypted = conn.execute(SQL_CREDENTIALS, (user.id,)).fetchone()
+            if encrypted is None:  # deleted since it was loaded
+                encrypted = (None,) * 7
+        return self._decrypt_many(encrypted)
     
     def create_user(self, username, password, trendyol_api_key=None, 
                    trendyol_api_secret=None, trendyol_supplier_id=None,
                    smartbill_api_token=None, smartbill_email=None, 
                    smartbill_company_cif=None, smartbill_gestiune=None, role='user'):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        password_hash = self._hash_password(password)
+        params = self._insert_params(
+            username, password, trendyol_api_key, trendyol_api_secret,
+            trendyol_supplier_id, smartbill_api_token, smartbill_email,
+            smartbill_company_cif, smartbill_gestiune, role)
         
-        try:
-            c.execute('''
-                INSERT INTO users (username, password_hash, trendyol_api_key, 
-                                 trendyol_api_secret, trendyol_supplier_id,
-                                 smartbill_api_token, smartbill_email, 
-                                 smartbill_company_cif, smartbill_gestiune, role)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                username,
-                password_hash,
-                self._encrypt(trendyol_api_key),
-                self._encrypt(trendyol_api_secret),
-                self._encrypt(trendyol_supplier_id),
-                self._encrypt(smartbill_api_token),
-                self._encrypt(smartbill_email),
-                self._encrypt(smartbill_company_cif),
-                self._encrypt(smartbill_gestiune),
-                role
-            ))
-            conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
-        finally:
-            conn.close()
+        with self._borrow(write=True) as conn:
+            try:
+                conn.execute(SQL_INSERT, params)
+                self._commit(conn)
+                return True
+            except sqlite3.IntegrityError:
+                return False
     
-    def authenticate_user(self, username, password):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+    def create_users(self, users):
+        """
+        Create several users in one transaction.
         
-        c.execute('''
-            SELECT id, username, password_hash, trendyol_api_key, trendyol_api_secret, 
-                   trendyol_supplier_id, smartbill_api_token, smartbill_email,
-                   smartbill_company_cif, smartbill_gestiune, role
-            FROM users 
-            WHERE username = ?
-        ''', (username,))
+        Args:
+            users: Dicts of create_user's keyword arguments
         
-        row = c.fetchone()
-        conn.close()
+        Returns:
+            True if all were created; False, creating none, if a username
+            is taken or repeated
+        """
+        rows = [self._insert_params(**user) for user in users]
         
-        if row and check_password_hash(row[2], password):
-            return User(
-                id=row[0],
-                username=row[1],
-                trendyol_api_key=self._decrypt(row[3]),
-                trendyol_api_secret=self._decrypt(row[4]),
-                trendyol_supplier_id=self._decrypt(row[5]),
-                smartbill_api_token=self._decrypt(row[6]),
-                smartbill_email=self._decrypt(row[7]),
-                smartbill_company_cif=self._decrypt(row[8]),
-                smartbill_gestiune=self._decrypt(row[9]),
-                role=row[10] if len(row) > 10 and row[10] else 'user'
-            )
-        return None
+        with self._borrow(write=True) as conn:
+            try:
+                conn.executemany(SQL_INSERT, rows)
+                self._commit(conn)
+                return True
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                return False
     
-    def get_user_by_id(self, user_id):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        c.execute('''
-            SELECT id, username, trendyol_api_key, trendyol_api_secret, 
-                   trendyol_supplier_id, smartbill_api_token, smartbill_email,
-                   smartbill_company_cif, smartbill_gestiune, role
-            FROM users 
-            WHERE id = ?
-        ''', (user_id,))
+    def _insert_params(self, username, password, trendyol_api_key=None,
+                       trendyol_api_secret=None, trendyol_supplier_id=None,
+                       smartbill_api_token=None, smartbill_email=None,
+                       smartbill_company_cif=None, smartbill_gestiune=None, role='user'):
+        return (
+            username,
+            self._hash_password(password),
+            self._encrypt(trendyol_api_key),
+            self._encrypt(trendyol_api_secret),
+            self._encrypt(trendyol_supplier_id),
+            self._encrypt(smartbill_api_token),
+            self._encrypt(smartbill_email),
+            self._encrypt(smartbill_company_cif),
+            self._encrypt(smartbill_gestiune),
+            role
+        )
+    
+    def authenticate_user(self, username, password):
+        with self._borrow() as conn:
+            row = conn.execute(SQL_AUTH, (username,)).fetchone()
         
-        row = c.fetchone()
-        conn.close()
+        # An unknown username still costs one hash check, so its response
+        # time and CPU load look the same as a wrong password's
+        matches, needs_rehash = self._verify_password(
+            row[2] if row else self._dummy_hash, password)
+        if not row or not matches:
+            return None
+        if needs_rehash:
+            password_hash = self._hash_password(password)
+            with self._borrow(write=True) as conn:
+                conn.execute(SQL_SET_PASSWORD_HASH, (password_hash, row[0]))
+                self._commit(conn)
+        return self._user_from_row(row[0], row[1], row[3:10], row[10])
+    
+    def get_user_by_id(self, user_id):
+        user = self._user_cache.get(user_id)
+        if user is None:
+            user = self._load_user_by_id(user_id)
+            if user:
+                self._user_cache.set(user_id, user)
+        return user
+    
+    def get_user_identity(self, user_id):
+        """
+        Like get_user_by_id, but a user not already cached is loaded with
+        only its id, username and role. Its credentials are read from the
+        database if they are used.
+        """
+        user = self._user_cache.get(user_id)
+        if user is None:
+            with self._borrow() as conn:
+                row = conn.execute(SQL_IDENTITY, (user_id,)).fetchone()
+            if row:
+                user = User(row[0], row[1], None, self._user_credentials,
+                            role=row[2] or 'user')
+                self._user_cache.set(user_id, user)
+        return user
+    
+    def _load_user_by_id(self, user_id):
+        with self._borrow() as conn:
+            row = conn.execute(SQL_GET_BY_ID, (user_id,)).fetchone()
         
         if row:
-            return User(
-                id=row[0],
-                username=row[1],
-                trendyol_api_key=self._decrypt(row[2]),
-                trendyol_api_secret=self._decrypt(row[3]),
-                trendyol_supplier_id=self._decrypt(row[4]),
-                smartbill_api_token=self._decrypt(row[5]),
-                smartbill_email=self._decrypt(row[6]),
-                smartbill_company_cif=self._decrypt(row[7]),
-                smartbill_gestiune=self._decrypt(row[8]),
-                role=row[9] if len(row) > 9 and row[9] else 'user'
-            )
+            return self._user_from_row(row[0], row[1], row[2:9], row[9])
         return None
     
     def get_all_users(self):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        c.execute('''
-            SELECT id, username, trendyol_api_key, trendyol_api_secret, 
-                   trendyol_supplier_id, smartbill_api_token, smartbill_email,
-                   smartbill_company_cif, smartbill_gestiune, role
-            FROM users
-        ''')
-        
-        rows = c.fetchall()
-        conn.close()
-        
-        users = []
-        for row in rows:
-            users.append(User(
-                id=row[0],
-                username=row[1],
-                trendyol_api_key=self._decrypt(row[2]),
-                trendyol_api_secret=self._decrypt(row[3]),
-                trendyol_supplier_id=self._decrypt(row[4]),
-                smartbill_api_token=self._decrypt(row[5]),
-                smartbill_email=self._decrypt(row[6]),
-                smartbill_company_cif=self._decrypt(row[7]),
-                smartbill_gestiune=self._decrypt(row[8]),
-                role=row[9] if len(row) > 9 and row[9] else 'user'
-            ))
-        return users
+        # Rows are built into users as the cursor steps over them
+        with self._borrow() as conn:
+            return [self._user_from_row(row[0], row[1], row[2:9], row[9])
+                    for row in conn.execute(SQL_ALL)]
     
     def update_user(self, user_id, username=None, password=None, trendyol_api_key=None,
                    trendyol_api_secret=None, trendyol_supplier_id=None,
                    smartbill_api_token=None, smartbill_email=None,
                    smartbill_company_cif=None, smartbill_gestiune=None, role=None):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        updates = []
-        params = []
-        
-        if username is not None:
-            updates.append("username = ?")
-            params.append(username)
-        if password is not None:
-            updates.append("password_hash = ?")
-            params.append(self._hash_password(password))
-        if trendyol_api_key is not None:
-            updates.append("trendyol_api_key = ?")
-            params.append(self._encrypt(trendyol_api_key))
-        if trendyol_api_secret is not None:
-            updates.append("trendyol_api_secret = ?")
-            params.append(self._encrypt(trendyol_api_secret))
-        if trendyol_supplier_id is not None:
-            updates.append("trendyol_supplier_id = ?")
-            params.append(self._encrypt(trendyol_supplier_id))
-        if smartbill_api_token is not None:
-            updates.append("smartbill_api_token = ?")
-            params.append(self._encrypt(smartbill_api_token))
-        if smartbill_email is not None:
-            updates.append("smartbill_email = ?")
-            params.append(self._encrypt(smartbill_email))
-        if smartbill_company_cif is not None:
-            updates.append("smartbill_company_cif = ?")
-            params.append(self._encrypt(smartbill_company_cif))
-        if smartbill_gestiune is not None:
-            updates.append("smartbill_gestiune = ?")
-            params.append(self._encrypt(smartbill_gestiune))
-        if role is not None:
-            updates.append("role = ?")
-            params.append(role)
-        
-        if not updates:
+        # One parameter per SQL_UPDATE column; None keeps the stored value
+        encrypt = self._encrypt
+        values = (
+            username,
+            None if password is None else self._hash_password(password),
+            *[encrypt(value) for value in (
+                trendyol_api_key, trendyol_api_secret, trendyol_supplier_id,
+                smartbill_api_token, smartbill_email, smartbill_company_cif,
+                smartbill_gestiune)],
+            role
+        )
+        if all(value is None for value in values):
             return False
-        
-        params.append(user_id)
-        query = f"UPDATE users SET {', '.join(updates)} WHERE id = ?"
+        params = (*values, user_id)
         
         try:
-            c.execute(query, params)
-            conn.commit()
+            with self._borrow(write=True) as conn:
+                conn.execute(SQL_UPDATE, params)
+                self._commit(conn)
             return True
         except sqlite3.IntegrityError:
             return False
         finally:
-            conn.close()
+            self._user_cache.delete(user_id)
     
     def delete_user(self, user_id):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        c.execute('DELETE FROM users WHERE id = ?', (user_id,))
-        conn.commit()
-        success = c.rowcount > 0
-        conn.close()
+        with self._borrow(write=True) as conn:
+            success = conn.execute(SQL_DELETE, (user_id,)).rowcount > 0
+            self._commit(conn)
+        self._user_cache.delete(user_id)
         return success